@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for BlindBot
+This script drives the real ImageContextBot cog with fake Discord objects, a local image server
+and a local stand-in for the OpenAI chat completions endpoint, so changes can be measured
+without touching Discord or spending API credits.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --workload burst --requests 500 --rate-429 0.1
+    python benchmark.py --workload resilience --error-rate 0.1 --slow-rate 0.05
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+from datetime import datetime, timezone
+
+# Keep the benchmark self-contained: no history file, no cache file, no real keys
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ['HISTORY_DB_PATH'] = ''
+os.environ['DESCRIPTION_CACHE_DB'] = ''
+os.environ['METRICS_PORT'] = '0'
+
+import openai
+from aiohttp import web
+from PIL import Image
+
+import bot
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+WORKLOADS = ['single', 'repeat', 'album', 'history', 'burst', 'resilience']
+
+
+class FakeServer:
+    """Local aiohttp server that serves images and emulates the OpenAI chat completions API"""
+
+    def __init__(self, latency=0.5, rate_429=0.0, error_rate=0.0, slow_rate=0.0, image_size=(1600, 1200)):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.error_rate = error_rate  # share of calls answered with a 500
+        self.slow_rate = slow_rate  # share of calls stuck ten times longer than usual
+        self.image_size = image_size
+        self.images = {}  # name -> bytes
+        self.completions = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.runner = None
+        self.port = None
+
+    def image_bytes(self, name):
+        """Generate (once) a distinct JPEG for a name"""
+        if name not in self.images:
+            seed = random.Random(name)
+            width, height = self.image_size
+            image = Image.new('RGB', (64, 48))
+            image.putdata([
+                (seed.randrange(256), seed.randrange(256), seed.randrange(256))
+                for _ in range(64 * 48)
+            ])
+            image = image.resize((width, height), Image.BICUBIC)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=90)
+            self.images[name] = buffer.getvalue()
+        return self.images[name]
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get('/images/{name}', self.handle_image)
+        app.router.add_post('/v1/chat/completions', self.handle_completion)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.port}/images/{name}"
+
+    def rendition_bytes(self, name, size):
+        """Generate (once) a resized copy of an image, like Discord's media proxy does"""
+        key = (name, size)
+        if key not in self.images:
+            with Image.open(io.BytesIO(self.image_bytes(name))) as image:
+                buffer = io.BytesIO()
+                image.resize(size, Image.LANCZOS).save(buffer, format='JPEG', quality=90)
+            self.images[key] = buffer.getvalue()
+        return self.images[key]
+
+    def prepare_rendition(self, url):
+        """Render a rendition URL ahead of time, so the run measures the bot rather than our resizing"""
+        query = dict(part.split('=') for part in url.split('?', 1)[1].split('&'))
+        self.rendition_bytes(url.split('?')[0].rsplit('/', 1)[1], (int(query['width']), int(query['height'])))
+
+    async def handle_image(self, request):
+        name = request.match_info['name']
+        if 'width' in request.query and 'height' in request.query:
+            size = (int(request.query['width']), int(request.query['height']))
+            return web.Response(body=self.rendition_bytes(name, size), content_type='image/jpeg')
+        return web.Response(body=self.image_bytes(name), content_type='image/jpeg')
+
+    async def handle_completion(self, request):
+        body = await request.json()
+        latency = max(0.0, random.gauss(self.latency, self.latency * 0.2))
+        if random.random() < self.slow_rate:
+            latency *= 10
+        await asyncio.sleep(latency)
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "The server had an error", "type": "server_error", "code": None}},
+                status=500
+            )
+
+        if random.random() < self.rate_429:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={'Retry-After': '0.5'}
+            )
+
+        self.completions += 1
+        content = body['messages'][0]['content']
+        image_count = sum(1 for part in content if part.get('type') == 'image_url')
+        if image_count > 1:
+            text = "\n\n".join(f"Image {i}:\n{self.description(i)}" for i in range(1, image_count + 1))
+        else:
+            text = self.description(1)
+        usage = {"prompt_tokens": 800 * image_count, "completion_tokens": 200, "total_tokens": 800 * image_count + 200}
+
+        if body.get('stream'):
+            return await self.stream_completion(request, body, text, usage)
+        return web.json_response({
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'gpt-4o'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    async def stream_completion(self, request, body, text, usage):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = text.split(' ')
+        for i in range(0, len(words), 5):
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get('model', 'gpt-4o'),
+                "choices": [{"index": 0, "delta": {"content": ' '.join(words[i:i + 5]) + ' '}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.01)
+        final = {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get('model', 'gpt-4o'),
+            "choices": [],
+            "usage": usage
+        }
+        await response.write(f"data: {json.dumps(final)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def description(number):
+        return (
+            f"This is benchmark description number {number}. A wide photo shows a park on a sunny afternoon, "
+            "with a wooden bench in the foreground, tall trees along the left edge and a small pond to the right. "
+            "The colors are mostly greens and blues. There is no readable text. The mood is calm and relaxed."
+        )
+
+
+class FakeMessage:
+    _next_id = 1000
+
+    def __init__(self, author, channel, content='', attachments=(), mentions=()):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel is not None else None
+        self.content = content
+        self.attachments = list(attachments)
+        self.mentions = list(mentions)
+        self.created_at = datetime.now(timezone.utc)
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        if emoji in self.reactions:
+            self.reactions.remove(emoji)
+
+    async def edit(self, content=None, embed=None):
+        self.content = content
+        return self
+
+
+class FakeAttachment:
+    _next_id = 5000
+
+    def __init__(self, server, name):
+        FakeAttachment._next_id += 1
+        self.id = FakeAttachment._next_id
+        self.filename = f"{name}.jpg"
+        self.url = server.url(name)
+        self.proxy_url = self.url
+        self.size = len(server.image_bytes(name))
+        self.width, self.height = server.image_size
+        self.content_type = 'image/jpeg'
+        self._server = server
+        self._name = name
+
+    async def read(self):
+        return self._server.image_bytes(self._name)
+
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = False
+        self.dms = []
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(self, None, content or '')
+        self.dms.append(message)
+        return message
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.guild = guild
+        self.messages = []  # oldest first
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(FakeUser(0, 'BlindBot'), self, content or '')
+        self.sent.append(message)
+        return message
+
+    async def history(self, limit=100, before=None):
+        for message in list(reversed(self.messages))[:limit]:
+            yield message
+
+    async def fetch_message(self, message_id):
+        return next(message for message in self.messages if message.id == message_id)
+
+    def post(self, message):
+        self.messages.append(message)
+        return message
+
+
+class FakeBot:
+    user = None
+    guilds = []
+
+
+def described(user):
+    """Whether a fake user has received an image description by DM"""
+    return any('Image Context' in dm.content for dm in user.dms)
+
+
+async def run_requests(cog, messages, concurrency):
+    """Feed messages to the cog with bounded concurrency, returning the elapsed seconds"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def deliver(message):
+        async with semaphore:
+            await cog.on_message(message)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[deliver(message) for message in messages])
+    return time.perf_counter() - started
+
+
+def build_workload(name, server, count):
+    """Create the channels and request messages for a workload"""
+    guilds = [FakeGuild(i) for i in range(1, 9)]
+    channels = [FakeChannel(100 + i, guild) for i, guild in enumerate(guilds)]
+    requests = []
+
+    if name == 'single':
+        for i in range(count):
+            requester = FakeUser(10_000 + i, f"user{i}")
+            channel = channels[i % len(channels)]
+            attachment = FakeAttachment(server, f"single-{i}")
+            requests.append(channel.post(FakeMessage(requester, channel, "tell me context of image", [attachment])))
+
+    elif name == 'repeat':
+        # The same handful of images asked about over and over
+        for i in range(count):
+            requester = FakeUser(10_000 + i, f"user{i}")
+            channel = channels[i % len(channels)]
+            attachment = FakeAttachment(server, f"repeat-{i % 5}")
+            requests.append(channel.post(FakeMessage(requester, channel, "tell me context of image", [attachment])))
+
+    elif name == 'album':
+        for i in range(max(1, count // 4)):
+            requester = FakeUser(10_000 + i, f"user{i}")
+            channel = channels[i % len(channels)]
+            attachments = [FakeAttachment(server, f"album-{i}-{j}") for j in range(4)]
+            requests.append(channel.post(FakeMessage(requester, channel, "tell me context of image", attachments)))
+
+    elif name == 'history':
+        posters = [FakeUser(20_000 + i, f"poster{i}") for i in range(20)]
+        for i, poster in enumerate(posters):
+            channel = channels[i % len(channels)]
+            for j in range(3):
+                channel.post(FakeMessage(poster, channel, "look at this", [FakeAttachment(server, f"post-{i}-{j}")]))
+            # Filler chatter so history scans have something to skip
+            for j in range(10):
+                channel.post(FakeMessage(FakeUser(30_000 + j, f"chatter{j}"), channel, "nice"))
+        for i in range(count):
+            poster = posters[i % len(posters)]
+            channel = channels[(i % len(posters)) % len(channels)]
+            requester = FakeUser(10_000 + i, f"user{i}")
+            requests.append(channel.post(FakeMessage(
+                requester, channel, f"image context of @{poster.name}", mentions=[poster]
+            )))
+
+    elif name == 'burst':
+        # Most of the storm comes from one busy guild
+        for i in range(count):
+            requester = FakeUser(10_000 + i, f"user{i}")
+            channel = channels[0] if i % 4 else channels[1 + i % (len(channels) - 1)]
+            attachment = FakeAttachment(server, f"burst-{i}")
+            requests.append(channel.post(FakeMessage(requester, channel, "tell me context of image", [attachment])))
+
+    elif name == 'resilience':
+        # Distinct images against a flaky upstream, so every request pays for the failures
+        for i in range(count):
+            requester = FakeUser(10_000 + i, f"user{i}")
+            channel = channels[i % len(channels)]
+            attachment = FakeAttachment(server, f"flaky-{i}")
+            requests.append(channel.post(FakeMessage(requester, channel, "tell me context of image", [attachment])))
+
+    return channels, requests
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+async def run_workload(name, server, args):
+    server.rate_429 = args.rate_429 if name == 'burst' else 0.0
+    server.error_rate = args.error_rate if name == 'resilience' else 0.0
+    server.slow_rate = args.slow_rate if name == 'resilience' else 0.0
+    channels, requests = build_workload(name, server, args.requests)
+
+    cog = bot.ImageContextBot(FakeBot())
+    cog.openai_client = openai.AsyncOpenAI(
+        api_key='benchmark',
+        base_url=f"http://127.0.0.1:{server.port}/v1",
+        max_retries=0
+    )
+    if name == 'resilience':
+        # Scale deadlines and backoff to the fake latency so slow calls are cut off and hedged
+        cog.resilience.attempt_timeout = args.latency * 6
+        cog.resilience.backoff_base = args.latency / 10
+        cog.resilience.hedge = not args.no_hedge
+    await cog.cog_load()
+    try:
+        # Images posted before the requests show up through on_message like they would live
+        request_ids = {message.id for message in requests}
+        for channel in channels:
+            for message in channel.messages:
+                if message.id not in request_ids:
+                    await cog.on_message(message)
+
+        for message in requests:
+            for attachment in message.attachments:
+                rendition_url = bot.proxy_rendition_url(attachment, bot.ATTACHMENT_PROXY_MAX_SIDE)
+                if rendition_url is not None:
+                    server.prepare_rendition(rendition_url)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        completions_before = server.completions
+        elapsed = await run_requests(cog, requests, args.concurrency)
+        if args.tracemalloc:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            allocated = [stat for stat in after.compare_to(before, 'filename') if stat.size_diff > 0]
+            blocks = sum(stat.count_diff for stat in allocated if stat.count_diff > 0)
+            allocated_bytes = sum(stat.size_diff for stat in allocated)
+    finally:
+        await cog.cog_unload()
+
+    succeeded = sum(1 for message in requests if described(message.author))
+    print(f"\n== {name}: {len(requests)} requests in {elapsed:.2f}s "
+          f"({len(requests) / elapsed:.1f} req/s), {succeeded} described, "
+          f"{server.completions - completions_before} API calls")
+    print(f"{'stage':<28}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, count, points in cog.metrics.stage_summary():
+        print(f"{stage:<28}{count:>8}{points[50] * 1000:>10.1f}{points[95] * 1000:>10.1f}{points[99] * 1000:>10.1f}")
+    if name == 'resilience':
+        resilience = cog.resilience
+        print(f"upstream: {server.errors} errors, retries {resilience.retries}, timeouts {resilience.timeouts}, "
+              f"hedges {resilience.hedges} (won {resilience.hedge_wins}), "
+              f"breaker {resilience.breaker.state} after {resilience.breaker.trips} trips")
+    saved = cog.metrics.counters.get(('proxy_bytes_saved_total', ()), 0)
+    if saved:
+        print(f"resized renditions saved {saved / (1024 * 1024):.1f} MB of downloads")
+    lag = cog.metrics.percentiles('event_loop_lag_seconds')
+    if lag:
+        print(f"event loop lag: {lag[50] * 1000:.1f}ms p50, {lag[99] * 1000:.1f}ms p99, "
+              f"{cog.loop_monitor.max_lag * 1000:.1f}ms max, {cog.loop_monitor.stalls} stalls")
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"peak RSS: {rss:.1f} MB")
+    if args.tracemalloc:
+        print(f"allocations: {blocks / len(requests):.0f} blocks, "
+              f"{allocated_bytes / len(requests) / 1024:.1f} KiB retained per request")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark BlindBot against local Discord and OpenAI stand-ins")
+    parser.add_argument('--workload', choices=WORKLOADS + ['all'], default='all')
+    parser.add_argument('--requests', type=int, default=200, help="requests per workload")
+    parser.add_argument('--concurrency', type=int, default=50, help="requests in flight at once")
+    parser.add_argument('--latency', type=float, default=0.5, help="mean fake OpenAI latency in seconds")
+    parser.add_argument('--rate-429', type=float, default=0.05, help="fraction of burst calls answered with 429")
+    parser.add_argument('--error-rate', type=float, default=0.1, help="fraction of resilience calls answered with 500")
+    parser.add_argument('--slow-rate', type=float, default=0.05, help="fraction of resilience calls that are 10x slower")
+    parser.add_argument('--no-hedge', action='store_true', help="don't hedge slow calls in the resilience workload")
+    parser.add_argument('--workers', type=int, default=bot.ANALYSIS_WORKERS, help="analysis worker pool size")
+    parser.add_argument('--processes', type=int, default=0, help="analysis worker processes, 0 analyzes in-process")
+    parser.add_argument('--cpu-executor', choices=['thread', 'process'], default=bot.CPU_EXECUTOR,
+                        help="where hashing, encoding and Pillow work run")
+    parser.add_argument('--max-side', type=int, default=bot.PREPROCESS_MAX_SIDE,
+                        help="longest side images are downscaled to before upload, 0 uploads originals")
+    parser.add_argument('--stream-upload-min-bytes', type=int, default=bot.STREAM_UPLOAD_MIN_BYTES,
+                        help="uploads at least this large are encoded while they're sent, 0 disables")
+    parser.add_argument('--proxy-max-side', type=int, default=bot.ATTACHMENT_PROXY_MAX_SIDE,
+                        help="fetch attachments larger than this as resized renditions, 0 downloads originals")
+    parser.add_argument('--queue-depth', type=int, default=1000, help="analysis queue depth")
+    parser.add_argument('--stream', action='store_true', help="stream descriptions into DMs")
+    parser.add_argument('--tracemalloc', action='store_true', help="measure allocations per request (slower)")
+    args = parser.parse_args()
+
+    # The benchmark measures the bot, not our OpenAI account's rate limits
+    bot.ANALYSIS_WORKERS = args.workers
+    bot.ANALYSIS_QUEUE_DEPTH = args.queue_depth
+    bot.OPENAI_REQUESTS_PER_MINUTE = 1_000_000
+    bot.OPENAI_TOKENS_PER_MINUTE = 1_000_000_000
+    bot.STREAM_RESPONSES = args.stream
+    bot.ANALYSIS_WORKER_PROCESSES = args.processes
+    bot.CPU_EXECUTOR = args.cpu_executor
+    bot.PREPROCESS_MAX_SIDE = args.max_side
+    bot.ATTACHMENT_PROXY_MAX_SIDE = args.proxy_max_side
+    bot.STREAM_UPLOAD_MIN_BYTES = args.stream_upload_min_bytes
+    # Sample often enough to catch short stalls, quietly
+    bot.LOOP_LAG_INTERVAL = 0.05
+    bot.LOOP_LAG_THRESHOLD = 1.0
+
+    server = FakeServer(latency=args.latency)
+    await server.start()
+    print(f"🏁 BlindBot benchmark (fake OpenAI latency {args.latency}s, {args.workers} workers, "
+          f"{args.processes or 'no'} worker processes, concurrency {args.concurrency})")
+    try:
+        for name in (WORKLOADS if args.workload == 'all' else [args.workload]):
+            await run_workload(name, server, args)
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,12 +4,31 @@ import openai
 import os
 import io
 import aiohttp
-from PIL import Image
+from aiohttp import web
+from PIL import Image, ImageOps, ImageSequence, ImageChops, ImageStat, ImageDraw, ImageFont, ImageFilter
 import logging
 import signal
 import sys
 import asyncio
 import time
+import hashlib
+import sqlite3
+import threading
+import zlib
+import json
+import tempfile
+import math
+import traceback
+import re
+import random
+import base64
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -24,111 +43,2656 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Sharding configuration, for bots in enough guilds that one gateway connection isn't enough
+BOT_AUTO_SHARD = os.getenv('BOT_AUTO_SHARD', 'false').lower() == 'true'
+BOT_SHARD_COUNT = int(os.getenv('BOT_SHARD_COUNT', '0'))  # 0 uses the count Discord recommends
+
+if BOT_AUTO_SHARD:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=BOT_SHARD_COUNT or None)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
 # OpenAI configuration
 openai.api_key = os.getenv('OPENAI_API_KEY')
+VISION_MODEL = "gpt-4o"
+VISION_PROMPT = "Provide a concise but detailed description of this image for a blind person. Include:\n- Main objects, people, scenes\n- Layout and positioning\n- Key colors and textures\n- Any readable text\n- Overall mood\n- Notable elements\n\nKeep it under 1500 characters while being descriptive and helpful."
+BATCH_PROMPT = "You will be shown {count} images. Describe each one for a blind person, in order, in its own section starting with a line that reads 'Image N:' (Image 1:, Image 2:, and so on). For each image include:\n- Main objects, people, scenes\n- Layout and positioning\n- Key colors and textures\n- Any readable text\n- Overall mood\n- Notable elements\n\nKeep each section under 1500 characters while being descriptive and helpful."
+
+# Routing configuration: which model, detail level and token budget each image gets
+ROUTING_POLICY = os.getenv('ROUTING_POLICY', 'quality').lower()  # quality, or balanced and economy to trade detail for cost
+ROUTING_FAST_MODEL = os.getenv('ROUTING_FAST_MODEL', 'gpt-4o-mini')  # cheaper model for simple images
+ROUTING_GUILD_POLICY_ENTRIES = [item.strip() for item in os.getenv('ROUTING_GUILD_POLICIES', '').split(',') if item.strip()]
+ROUTING_GUILD_POLICIES = {
+    int(guild_id): policy.strip().lower()
+    for guild_id, _, policy in (item.partition(':') for item in ROUTING_GUILD_POLICY_ENTRIES)
+    if guild_id.strip().isdigit()
+}
+ROUTING_POLICIES = ('quality', 'balanced', 'economy')
+
+def routing_config_errors():
+    """Describe any configured routing policy that isn't one of ROUTING_POLICIES, or isn't tied to a server ID"""
+    errors = []
+    if ROUTING_POLICY not in ROUTING_POLICIES:
+        errors.append(f"ROUTING_POLICY '{ROUTING_POLICY}' is not one of {', '.join(ROUTING_POLICIES)}")
+    for entry in ROUTING_GUILD_POLICY_ENTRIES:
+        guild_id, _, policy = entry.partition(':')
+        if not guild_id.strip().isdigit():
+            errors.append(f"ROUTING_GUILD_POLICIES entry '{entry}' should be a numeric server ID and a policy, like 123456789:economy")
+        elif policy.strip().lower() not in ROUTING_POLICIES:
+            errors.append(f"ROUTING_GUILD_POLICIES entry '{entry}' is not one of {', '.join(ROUTING_POLICIES)}")
+    return errors
+
+# Instant preview configuration
+LOCAL_PREVIEW = os.getenv('LOCAL_PREVIEW', 'true').lower() == 'true'  # DM basic facts about an image before its description
+SKIP_TRIVIAL_IMAGES = os.getenv('SKIP_TRIVIAL_IMAGES', 'true').lower() == 'true'  # describe solid colours and tiny images locally
+TRIVIAL_MAX_SIDE = int(os.getenv('TRIVIAL_MAX_SIDE', '48'))  # pixels, images this small are described locally
+TRIVIAL_SOLID_SHARE = 0.97  # share of a thumbnail's pixels in one colour before the full image is checked
+TRIVIAL_SOLID_TOLERANCE = 8  # most any channel may vary across a full-size image that is described as solid
+# A single colour compresses to a few hundredths of a byte per pixel, so only files this small are checked before analysis
+TRIVIAL_MAX_BYTES_PER_PIXEL = 0.025
+COLOUR_NAMES = (
+    ('black', (0, 0, 0)), ('dark gray', (64, 64, 64)), ('gray', (128, 128, 128)), ('light gray', (192, 192, 192)),
+    ('light gray', (232, 232, 232)), ('white', (255, 255, 255)), ('red', (220, 30, 30)), ('dark red', (128, 0, 0)), ('orange', (255, 140, 0)),
+    ('yellow', (250, 220, 40)), ('olive', (128, 128, 0)), ('green', (40, 170, 60)), ('dark green', (0, 90, 30)),
+    ('teal', (0, 128, 128)), ('light blue', (130, 200, 240)), ('blue', (30, 90, 220)), ('navy', (0, 0, 110)),
+    ('purple', (120, 50, 160)), ('pink', (245, 150, 190)), ('magenta', (220, 40, 180)), ('brown', (130, 80, 40)),
+    ('beige', (225, 205, 165))
+)
+
+# Streaming configuration
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'false').lower() == 'true'  # show descriptions as they're written
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))  # seconds between DM edits
+DM_MESSAGE_LIMIT = 2000
+
+# Channel status configuration
+STATUS_MODE = os.getenv('STATUS_MODE', 'message').lower()  # 'message' edits one status message, 'reactions' only reacts
+STATUS_EDIT_INTERVAL = float(os.getenv('STATUS_EDIT_INTERVAL', '1.0'))  # seconds status changes are coalesced for
+
+# DM delivery configuration
+DM_USE_EMBEDS = os.getenv('DM_USE_EMBEDS', 'false').lower() == 'true'  # send descriptions as embeds (up to 4096 characters each)
+DM_SEND_ATTEMPTS = int(os.getenv('DM_SEND_ATTEMPTS', '5'))  # tries per DM before giving up on rate limits and server errors
+EMBED_DESCRIPTION_LIMIT = 4096
+
+# Multi-image configuration
+MAX_IMAGES_PER_REQUEST = int(os.getenv('MAX_IMAGES_PER_REQUEST', '10'))
+MULTI_IMAGE_BATCH_SIZE = int(os.getenv('MULTI_IMAGE_BATCH_SIZE', '0'))  # images per API call, 0 or 1 disables batching
+
+# Description cache configuration
+DESCRIPTION_CACHE_SIZE = int(os.getenv('DESCRIPTION_CACHE_SIZE', '256'))  # entries kept in memory
+DESCRIPTION_CACHE_TTL = int(os.getenv('DESCRIPTION_CACHE_TTL', '86400'))  # seconds
+DESCRIPTION_CACHE_DB = os.getenv('DESCRIPTION_CACHE_DB', '')  # SQLite file, empty disables the disk tier
+
+# Near-duplicate matching configuration
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', '6'))  # max differing bits out of 64
+PHASH_INDEX_SIZE = int(os.getenv('PHASH_INDEX_SIZE', '5000'))  # hashes kept in the index
+# Flat images and plain gradients hash to (nearly) all zeros or all ones whatever their colours, so they only match exactly
+PHASH_MIN_DETAIL_BITS = 4
+
+# Image download configuration
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', '64'))
+DOWNLOAD_MAX_CONNECTIONS_PER_HOST = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS_PER_HOST', '16'))
+DOWNLOAD_KEEPALIVE = float(os.getenv('DOWNLOAD_KEEPALIVE', '60'))  # seconds an idle connection is kept
+DOWNLOAD_DNS_CACHE_TTL = int(os.getenv('DOWNLOAD_DNS_CACHE_TTL', '300'))  # seconds
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv('DOWNLOAD_CONNECT_TIMEOUT', '5'))  # seconds
+DOWNLOAD_READ_TIMEOUT = float(os.getenv('DOWNLOAD_READ_TIMEOUT', '20'))  # seconds between reads
+DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', str(25 * 1024 * 1024)))  # larger downloads are aborted
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Downloads larger than this are spooled to a temporary file while they arrive, so only the finished image is held in memory
+DOWNLOAD_SPOOL_BYTES = int(os.getenv('DOWNLOAD_SPOOL_BYTES', str(1024 * 1024)))
+# Attachments larger than this on their longest side are fetched as a resized rendition from Discord's media proxy, 0 disables
+ATTACHMENT_PROXY_MAX_SIDE = int(os.getenv('ATTACHMENT_PROXY_MAX_SIDE', '1536'))
+# Read attachments through discord.py's own HTTP session instead of the download pool
+USE_DISCORD_ATTACHMENT_READ = os.getenv('USE_DISCORD_ATTACHMENT_READ', 'false').lower() == 'true'
+
+# Image preprocessing configuration
+PREPROCESS_MAX_SIDE = int(os.getenv('PREPROCESS_MAX_SIDE', '2048'))  # pixels, 0 disables preprocessing
+PREPROCESS_FORMAT = os.getenv('PREPROCESS_FORMAT', 'JPEG').upper()  # JPEG or WEBP
+PREPROCESS_QUALITY = int(os.getenv('PREPROCESS_QUALITY', '85'))
+
+# Animated image configuration
+ANIMATION_MAX_FRAMES = int(os.getenv('ANIMATION_MAX_FRAMES', '9'))  # keyframes tiled into a contact sheet, 0 or 1 sends the first frame only
+ANIMATION_DECODE_SECONDS = float(os.getenv('ANIMATION_DECODE_SECONDS', '2.0'))  # frames after this much decoding are skipped
+KEYFRAME_MIN_CHANGE = 0.02  # share of pixels that must differ from the last keyframe for a frame to count as a new one
+ANIMATION_NOTE = "This image is a contact sheet of {shown} keyframes from an animation{length}, in playback order from left to right and top to bottom, each labelled with its frame number. Describe it as one animation: what is shown and what happens over time, rather than each frame separately."
+
+# Image history configuration
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'image_history.db')  # empty keeps history in memory only
+HISTORY_MAX_PER_USER = int(os.getenv('HISTORY_MAX_PER_USER', '50'))
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '90'))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '1.0'))  # seconds writes are batched for
+HISTORY_BATCH_SIZE = 100
+# Global limits for in-memory history, across all users; least recently active users lose their oldest entries first
+HISTORY_MEMORY_MAX_ENTRIES = int(os.getenv('HISTORY_MEMORY_MAX_ENTRIES', '20000'))
+HISTORY_MEMORY_MAX_BYTES = int(os.getenv('HISTORY_MEMORY_MAX_BYTES', str(32 * 1024 * 1024)))
+HISTORY_COMPRESS = os.getenv('HISTORY_COMPRESS', 'false').lower() == 'true'  # zlib-compress in-memory descriptions
+HISTORY_SWEEP_INTERVAL = 3600  # seconds between sweeps for expired in-memory entries
+
+# Recent image index configuration
+RECENT_IMAGES_PER_AUTHOR = int(os.getenv('RECENT_IMAGES_PER_AUTHOR', '3'))  # images remembered per author per channel
+RECENT_IMAGE_INDEX_SIZE = int(os.getenv('RECENT_IMAGE_INDEX_SIZE', '50000'))  # (channel, author) pairs remembered
+
+# Analysis scheduler configuration
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '4'))  # concurrent OpenAI calls
+ANALYSIS_QUEUE_DEPTH = int(os.getenv('ANALYSIS_QUEUE_DEPTH', '50'))  # queued jobs before new ones are turned away
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', '30000'))
+ANALYSIS_TOKENS_PER_REQUEST = int(os.getenv('ANALYSIS_TOKENS_PER_REQUEST', '1500'))  # estimate, corrected from usage
+ANALYSIS_RATE_LIMIT_RETRIES = 2
+# Worker processes that preprocess, encode and describe images, so the gateway process only does I/O; 0 runs everything in-process
+ANALYSIS_WORKER_PROCESSES = int(os.getenv('ANALYSIS_WORKER_PROCESSES', '0'))
+
+# Speculative pre-analysis of images posted in opted-in channels
+PREFETCH_CHANNEL_IDS = {int(c) for c in os.getenv('PREFETCH_CHANNEL_IDS', '').split(',') if c.strip()}
+PREFETCH_PER_HOUR = int(os.getenv('PREFETCH_PER_HOUR', '60'))  # background analyses allowed per hour, 0 disables
+PREFETCH_QUEUE_DEPTH = int(os.getenv('PREFETCH_QUEUE_DEPTH', '20'))  # queued background analyses before new ones are skipped
+
+# Vision call resilience configuration
+OPENAI_ATTEMPT_TIMEOUT = float(os.getenv('OPENAI_ATTEMPT_TIMEOUT', '45'))  # seconds one API attempt may take
+OPENAI_TOTAL_TIMEOUT = float(os.getenv('OPENAI_TOTAL_TIMEOUT', '120'))  # seconds all attempts for one image may take
+OPENAI_MAX_ATTEMPTS = int(os.getenv('OPENAI_MAX_ATTEMPTS', '3'))
+OPENAI_BACKOFF_BASE = float(os.getenv('OPENAI_BACKOFF_BASE', '0.5'))  # seconds, doubled on each retry
+OPENAI_BACKOFF_MAX = float(os.getenv('OPENAI_BACKOFF_MAX', '10'))
+OPENAI_HEDGE = os.getenv('OPENAI_HEDGE', 'false').lower() == 'true'  # send a second attempt when the first is slower than p95
+OPENAI_HEDGE_MIN_SAMPLES = 20  # attempts observed before hedging starts
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))  # consecutive failures that open the circuit
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))  # seconds before a trial call is let through
+
+# CPU work configuration: hashing, base64 encoding and Pillow decoding run here instead of on the event loop
+CPU_EXECUTOR = os.getenv('CPU_EXECUTOR', 'thread').lower()  # 'thread' or 'process'
+CPU_EXECUTOR_WORKERS = int(os.getenv('CPU_EXECUTOR_WORKERS', str(min(4, os.cpu_count() or 1))))
+CPU_OFFLOAD_MIN_BYTES = 64 * 1024  # smaller inputs are hashed and encoded inline, handing them off costs more
+
+# Event loop lag monitoring
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))  # seconds between samples, 0 disables the monitor
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))  # seconds blocked before the running code is logged
+
+# Metrics configuration
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Prometheus endpoint port, 0 disables it
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Uploads at least this large are base64-encoded while the request is sent instead of built in memory, 0 disables
+STREAM_UPLOAD_MIN_BYTES = int(os.getenv('STREAM_UPLOAD_MIN_BYTES', str(1024 * 1024)))
+STREAM_UPLOAD_CHUNK_BYTES = 3 * 16 * 1024  # a multiple of 3, so encoded chunks join without padding in between
+STREAM_UPLOAD_PLACEHOLDER = 'blindbot-streamed-image-url'
+
+# Formats the vision API accepts as-is
+UPLOAD_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif'
+}
+
+def signal_handler(signum, frame):
+    """Handle shutdown signals gracefully"""
+    logger.info(f"Received signal {signum}, initiating graceful shutdown...")
+    # Exit gracefully
+    sys.exit(0)
+
+# Register signal handlers for graceful shutdown
+signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
+
+class DescriptionCache:
+    """Cache of image descriptions keyed by image content, prompt and model"""
+
+    def __init__(self, max_entries=256, ttl=86400, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (stored_at, description)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        self.db_lock = threading.Lock()
+        if db_path:
+            try:
+                self.db = sqlite3.connect(db_path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS descriptions ("
+                    "key TEXT PRIMARY KEY, stored_at REAL NOT NULL, description TEXT NOT NULL)"
+                )
+                self.db.execute("CREATE INDEX IF NOT EXISTS idx_descriptions_stored_at ON descriptions (stored_at)")
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Could not open description cache database {db_path}: {e}")
+                self.db = None
+
+    @staticmethod
+    def make_key(image_data, prompt, model):
+        """Build a cache key from the image bytes, prompt and model"""
+        digest = hashlib.sha256()
+        digest.update(model.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(prompt.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(image_data)
+        return digest.hexdigest()
+
+    async def get(self, key):
+        """Return a cached description, or None on a miss"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            stored_at, description = entry
+            if time.time() - stored_at < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return description
+            del self.entries[key]
+
+        if self.db is not None:
+            loop = asyncio.get_running_loop()
+            row = await loop.run_in_executor(None, self._db_get, key)
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return row[1]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key, description):
+        """Store a description in memory and, if enabled, on disk"""
+        stored_at = time.time()
+        self._remember(key, stored_at, description)
+        if self.db is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._db_set, key, stored_at, description)
+
+    def _remember(self, key, stored_at, description):
+        self.entries[key] = (stored_at, description)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _db_get(self, key):
+        try:
+            with self.db_lock:
+                return self.db.execute(
+                    "SELECT stored_at, description FROM descriptions WHERE key = ? AND stored_at >= ?",
+                    (key, time.time() - self.ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading description cache: {e}")
+            return None
+
+    def _db_set(self, key, stored_at, description):
+        try:
+            with self.db_lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO descriptions (key, stored_at, description) VALUES (?, ?, ?)",
+                    (key, stored_at, description)
+                )
+                # Drop expired rows so the file doesn't grow forever
+                self.db.execute("DELETE FROM descriptions WHERE stored_at < ?", (stored_at - self.ttl,))
+                self.db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error writing description cache: {e}")
+
+    def stats(self):
+        """Return hit/miss counters for the cache"""
+        lookups = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate
+        }
+
+    def close(self):
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+            self.db = None
+
+def sniff_image_type(data):
+    """Return an image's MIME type from its magic bytes, or None if it isn't a known image"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:2] == b'BM':
+        return 'image/bmp'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    return None
+
+def proxy_rendition_url(attachment, max_side):
+    """URL of a rendition of an attachment scaled to fit max_side, from Discord's media proxy, or None to use the original"""
+    width, height = getattr(attachment, 'width', None), getattr(attachment, 'height', None)
+    proxy_url = getattr(attachment, 'proxy_url', None)
+    if max_side <= 0 or not width or not height or not proxy_url or max(width, height) <= max_side:
+        return None
+    # The proxy renders animations as a still, which would lose the contact sheet
+    content_type = (getattr(attachment, 'content_type', None) or '').split(';')[0]
+    if content_type in ('image/gif', 'image/webp') or attachment.filename.lower().endswith(('.gif', '.webp')):
+        return None
+    scale = max_side / max(width, height)
+    separator = '&' if '?' in proxy_url else '?'
+    return f"{proxy_url}{separator}width={max(1, round(width * scale))}&height={max(1, round(height * scale))}"
+
+def build_contact_sheet(img, max_frames=9, max_seconds=2.0, max_side=2048):
+    """Tile an animation's most distinct frames into one image, returning (sheet, frame info) or None if it barely moves"""
+    started = time.monotonic()
+    # Cells keep the animation's shape and are never larger than its frames
+    scale = min(1.0, (max_side // math.ceil(math.sqrt(max_frames))) / max(img.size))
+    cell = (max(round(img.width * scale), 1), max(round(img.height * scale), 1))
+    keyframes = []  # [change from the previous keyframe, frame number, tile]
+    previous = None
+    total = 0
+    duration = 0
+    complete = True
+    # Frames are decoded one at a time, only small tiles of the keyframes are kept
+    for number, frame in enumerate(ImageSequence.Iterator(img), 1):
+        if time.monotonic() - started > max_seconds:
+            complete = False
+            break
+        total += 1
+        duration += frame.info.get('duration') or 0
+        signature = frame.convert('L').resize((64, 64))
+        if previous is None:
+            change = float('inf')  # the first frame is always kept
+        else:
+            # Share of pixels that changed noticeably, so small moving objects still count
+            changed = ImageChops.difference(signature, previous).point(lambda value: 255 if value > 32 else 0)
+            change = ImageStat.Stat(changed).mean[0] / 255
+            if change < KEYFRAME_MIN_CHANGE:
+                continue
+        previous = signature
+        tile = frame.convert('RGB').resize(cell, Image.LANCZOS)
+        keyframes.append([change, number, tile])
+        if len(keyframes) > max_frames:
+            # Over the cap, the least distinct keyframe goes (never the first)
+            keyframes.remove(min(keyframes[1:], key=lambda keyframe: keyframe[0]))
+
+    if len(keyframes) < 2:
+        return None
+
+    columns = math.ceil(math.sqrt(len(keyframes)))
+    rows = math.ceil(len(keyframes) / columns)
+    gap = 4
+    sheet = Image.new('RGB', (columns * (cell[0] + gap) - gap, rows * (cell[1] + gap) - gap), 'white')
+    draw = ImageDraw.Draw(sheet)
+    try:
+        font = ImageFont.load_default(size=max(min(cell) // 10, 12))
+    except TypeError:  # Pillow before 10.1 only has the small bitmap font
+        font = ImageFont.load_default()
+    for position, (change, number, tile) in enumerate(keyframes):
+        left = (position % columns) * (cell[0] + gap)
+        top = (position // columns) * (cell[1] + gap)
+        sheet.paste(tile, (left, top))
+        draw.text((left + 6, top + 4), f"#{number}", fill='white', font=font, stroke_width=2, stroke_fill='black')
+    info = {'shown': len(keyframes), 'total': total, 'seconds': duration / 1000, 'complete': complete}
+    return sheet, info
+
+def animation_note(info):
+    """Prompt text explaining a contact sheet to the model"""
+    if not info['complete']:
+        length = f" (only its first {info['total']} frames were read)"
+    elif info['seconds']:
+        length = f" of {info['total']} frames lasting {info['seconds']:.1f} seconds"
+    else:
+        length = f" of {info['total']} frames"
+    return ANIMATION_NOTE.format(shown=info['shown'], length=length)
+
+def preprocess_image(image_data, max_side=2048, output_format='JPEG', quality=85, max_frames=9, max_frame_seconds=2.0):
+    """Decode, orient, downscale and re-encode an image for upload, returning (bytes, MIME type, animation info)"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        source_format = img.format
+        original_size = img.size
+        orientation = img.getexif().get(0x0112, 1)
+        # Animations become one image of their keyframes so the model sees more than the first frame
+        animation = None
+        if max_frames > 1 and getattr(img, 'is_animated', False):
+            animation = build_contact_sheet(img, max_frames, max_frame_seconds, max_side)
+            img.seek(0)
+        if animation is not None:
+            img, frames = animation
+            has_alpha = False
+        else:
+            frames = None
+            # JPEG draft mode decodes straight at the smallest 1/2, 1/4 or 1/8 scale that still covers max_side
+            img.draft('RGB', (max_side, max_side))
+            img = ImageOps.exif_transpose(img)
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        # JPEG has no alpha channel, so transparent images go out as WebP instead
+        if has_alpha:
+            output_format = 'WEBP'
+            img = img.convert('RGBA')
+        else:
+            img = img.convert('RGB')
+
+        buffer = io.BytesIO()
+        if output_format == 'WEBP':
+            img.save(buffer, format='WEBP', quality=quality, method=4)
+        else:
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        encoded = buffer.getvalue()
+
+    # An already small, upright image in a supported format may be better left alone
+    untouched = max(original_size) <= max_side and orientation == 1 and frames is None
+    if untouched and source_format in UPLOAD_MIME_TYPES and len(encoded) >= len(image_data):
+        return image_data, UPLOAD_MIME_TYPES[source_format], None
+    return encoded, UPLOAD_MIME_TYPES[output_format], frames
+
+def to_data_url(data, mime_type):
+    """Encode image bytes as a base64 data URL for the vision API"""
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+def compute_dhash(image_data, hash_size=8):
+    """Compute a difference hash (dHash) of an image as a 64-bit integer"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        # Let the JPEG decoder skip straight to a reduced scale, we only need a thumbnail
+        img.draft('L', (hash_size * 4, hash_size * 4))
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+ImageFeatures = namedtuple('ImageFeatures', 'width height entropy edge_density text_like')
+Route = namedtuple('Route', 'name model detail max_tokens')
+
+def extract_image_features(image_data, sample_side=256):
+    """Measure cheap image features for routing from a small grayscale copy"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        width, height = img.size
+        img.draft('L', (sample_side, sample_side))
+        small = img.convert('L')
+    small.thumbnail((sample_side, sample_side))
+    return measure_features(small, width, height)
+
+def measure_features(small, width, height):
+    """Routing features of an image from a grayscale copy at most a few hundred pixels across"""
+    entropy = small.entropy()
+    # Share of pixels on a strong edge
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda value: 255 if value > 48 else 0)
+    # The filter marks the image border as an edge, so leave it out
+    edges = edges.crop((1, 1, max(edges.width - 1, 2), max(edges.height - 1, 2)))
+    edge_density = ImageStat.Stat(edges).mean[0] / 255
+    # Screenshots and documents are mostly one or two flat tones with lots of sharp edges
+    histogram = small.histogram()
+    bands = sorted((sum(histogram[i:i + 16]) for i in range(0, 256, 16)), reverse=True)
+    flat_share = (bands[0] + bands[1]) / max(sum(bands), 1)
+    text_like = (edge_density >= 0.04 and flat_share >= 0.6) or (edge_density > 0.0005 and flat_share >= 0.95)
+    return ImageFeatures(width, height, entropy, edge_density, text_like)
+
+def choose_route(features, policy):
+    """Pick the model, detail level and token budget for an image under a routing policy"""
+    if policy == 'quality' or features is None:
+        return Route('default', VISION_MODEL, 'auto', 500)
+    if max(features.width, features.height) <= 128:
+        # Icons and emoji don't need the big model or many words
+        return Route('simple', ROUTING_FAST_MODEL, 'low', 200)
+    if features.text_like:
+        # Text has to be read, so screenshots always get full detail
+        return Route('text', VISION_MODEL, 'high', 700)
+    if features.entropy < 1.0:
+        # Near-solid images have little to describe
+        return Route('simple', ROUTING_FAST_MODEL, 'low', 200)
+    if policy == 'economy':
+        return Route('photo', ROUTING_FAST_MODEL, 'low', 400)
+    return Route('photo', VISION_MODEL, 'low', 500)
+
+ImagePreview = namedtuple('ImagePreview', 'width height orientation colours kind frames trivial')
+
+def colour_name(rgb):
+    """Name the basic colour closest to an RGB value"""
+    return min(COLOUR_NAMES, key=lambda item: sum((a - b) ** 2 for a, b in zip(rgb, item[1])))[0]
+
+def dominant_colours(img, count=3):
+    """Return [(share, colour name)] for an image's most common colours, largest first"""
+    small = img.convert('RGBA')
+    small.thumbnail((64, 64))
+    # Transparent pixels aren't part of the picture, so they aren't counted unless there's nothing else
+    counted = small.getcolors(small.width * small.height)
+    opaque = [(n, rgba) for n, rgba in counted if rgba[3] >= 128]
+    counted = opaque or counted
+    # Four levels per channel gives 64 bins; each bin's colour is the mean of its pixels
+    bins = {}
+    for n, (r, g, b, a) in counted:
+        totals = bins.setdefault((r >> 6, g >> 6, b >> 6), [0, 0, 0, 0])
+        totals[0] += n
+        totals[1] += n * r
+        totals[2] += n * g
+        totals[3] += n * b
+    pixels = sum(totals[0] for totals in bins.values())
+    named = {}
+    for n, r, g, b in bins.values():
+        name = colour_name((r // n, g // n, b // n))
+        named[name] = named.get(name, 0.0) + n / pixels
+    return sorted(((share, name) for name, share in named.items()), reverse=True)[:count]
+
+def might_be_trivial(image_data, trivial_max_side=48):
+    """Whether an image could be described locally, judged from its header and file size without decoding it"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        width, height = img.size
+        animated = getattr(img, 'is_animated', False)
+    if animated:
+        return False
+    # The allowance covers headers and metadata, which dominate small files
+    return max(width, height) <= trivial_max_side or len(image_data) <= TRIVIAL_MAX_BYTES_PER_PIXEL * width * height + 2048
+
+def is_uniform(image_data, tolerance=TRIVIAL_SOLID_TOLERANCE):
+    """Whether every pixel of an image, decoded at full size, is within a tolerance of the same colour"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        full = img if img.mode in ('L', 'LA', 'RGB', 'RGBA') else img.convert('RGBA')
+        extrema = full.getextrema()
+    if isinstance(extrema[0], int):
+        extrema = (extrema,)
+    return all(high - low <= tolerance for low, high in extrema)
+
+def build_preview(image_data, trivial_max_side=48):
+    """Work out basic facts about an image without the API: size, orientation, colours, kind and frame count"""
+    # Decoded once, at the reduced scale the routing features use, for both the colours and the features
+    with Image.open(io.BytesIO(image_data)) as img:
+        width, height = img.size
+        frames = getattr(img, 'n_frames', 1)
+        img.draft('RGB', (256, 256))
+        sample = img.convert('RGBA')
+    sample.thumbnail((256, 256))
+    colours = dominant_colours(sample)
+    features = measure_features(sample.convert('L'), width, height)
+    if abs(width - height) <= 0.05 * max(width, height):
+        orientation = 'square'
+    else:
+        orientation = 'landscape' if width > height else 'portrait'
+    # Small text or objects on a plain background vanish at thumbnail size, so only the full image can prove it's solid
+    solid = frames == 1 and colours[0][0] >= TRIVIAL_SOLID_SHARE and is_uniform(image_data)
+    if solid:
+        kind = 'a solid colour'
+    elif frames > 1:
+        kind = 'an animation'
+    elif max(width, height) <= 128:
+        kind = 'an icon or emoji'
+    elif features.text_like:
+        kind = 'a screenshot or text'
+    elif features.entropy < 1.0:
+        kind = 'a simple graphic'
+    else:
+        kind = 'a photo or detailed picture'
+    trivial = solid or (frames == 1 and max(width, height) <= trivial_max_side)
+    return ImagePreview(width, height, orientation, colours, kind, frames, trivial)
+
+def describe_colours(colours):
+    names = [name for share, name in colours if share >= 0.1] or [colours[0][1]]
+    if len(names) == 1:
+        return f"mostly {names[0]}"
+    return f"mostly {names[0]}, with {' and '.join(names[1:])}"
+
+def format_preview(preview):
+    """The quick look DM text for an image"""
+    lines = [
+        f"📐 {preview.width} × {preview.height} pixels, {preview.orientation}",
+        f"🎨 {describe_colours(preview.colours).capitalize()}",
+        f"🔎 Looks like {preview.kind}"
+    ]
+    if preview.frames > 1:
+        lines.append(f"🎞️ Animated, {preview.frames} frames")
+    return '\n'.join(lines)
+
+def trivial_description(preview):
+    """A complete description for an image too simple to need the API"""
+    if preview.kind == 'a solid colour':
+        return f"A solid {preview.colours[0][1]} image, {preview.width} × {preview.height} pixels, with nothing else in it."
+    return (f"A tiny {preview.width} × {preview.height} pixel image, about the size of an emoji, "
+            f"{describe_colours(preview.colours)}. It's too small to show any detail.")
+
+# OpenAI client of an analysis worker process, created by init_analysis_worker
+_worker_client = None
+
+class UpstreamAPIError(Exception):
+    """An OpenAI error reduced to a message and Retry-After, where an SDK exception can't be passed on
+
+    Raised by analysis worker processes, whose errors have to survive pickling, and by requests sent without the SDK.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return self.__class__, (str(self), self.retry_after)
+
+class UpstreamRateLimitError(UpstreamAPIError):
+    pass
+
+class UpstreamRetryableError(UpstreamAPIError):
+    pass
+
+def init_analysis_worker(api_key, base_url, timeout, ready=None):
+    """Set up an analysis worker process with its own blocking OpenAI client"""
+    global _worker_client
+    _worker_client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout)
+    if ready is not None:
+        # Hold the first jobs until every worker has started, so startup is paid once and up front
+        try:
+            ready.wait(timeout=60)
+        except threading.BrokenBarrierError:
+            pass
+
+def analyze_in_worker(image_data, policy, max_side, output_format, quality, max_frames, max_frame_seconds):
+    """Preprocess, route, encode and describe an image inside an analysis worker process
+
+    Returns a dict with the description, token usage, route, animation info, upload size, per-stage seconds
+    and the seconds the API call took.
+    """
+    timings = {}
+    started = time.perf_counter()
+    upload_data, mime_type, frames = image_data, sniff_image_type(image_data) or 'image/jpeg', None
+    if max_side > 0:
+        try:
+            upload_data, mime_type, frames = preprocess_image(
+                image_data, max_side, output_format, quality, max_frames, max_frame_seconds
+            )
+        except Exception as e:
+            logger.warning(f"Could not preprocess image, uploading original: {e}")
+    timings['preprocess'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    features = None
+    if policy != 'quality':
+        try:
+            features = extract_image_features(image_data)
+        except Exception as e:
+            logger.warning(f"Could not measure image features, using the default route: {e}")
+    route = choose_route(features, policy)
+    prompt = VISION_PROMPT
+    if frames is not None:
+        route = route._replace(detail='high')
+        prompt = f"{VISION_PROMPT}\n\n{animation_note(frames)}"
+    timings['routing'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    image_url = to_data_url(upload_data, mime_type)
+    timings['encode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        response = _worker_client.chat.completions.create(
+            model=route.model,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": image_url, "detail": route.detail}}
+                ]
+            }],
+            max_tokens=route.max_tokens,
+            temperature=0.7
+        )
+    except openai.RateLimitError as e:
+        raise UpstreamRateLimitError(str(e), retry_after_seconds(e, default=None))
+    except (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+        raise UpstreamRetryableError(str(e), retry_after_seconds(e, default=None))
+    except openai.OpenAIError as e:
+        raise UpstreamAPIError(f"{type(e).__name__}: {e}")
+    api_seconds = time.perf_counter() - started
+
+    usage = getattr(response, 'usage', None)
+    return {
+        'description': response.choices[0].message.content,
+        'total_tokens': usage.total_tokens if usage is not None else None,
+        'route': route,
+        'frames': frames,
+        'upload_bytes': len(upload_data),
+        'timings': timings,
+        'api_seconds': api_seconds
+    }
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+def hash_has_detail(phash, bits=64):
+    """Whether a perceptual hash has enough structure for near-duplicate matching to mean anything"""
+    ones = bin(phash).count('1')
+    return min(ones, bits - ones) >= PHASH_MIN_DETAIL_BITS
+
+class BKTree:
+    """BK-tree over perceptual hashes for sub-linear Hamming distance searches"""
+
+    def __init__(self):
+        self.root = None  # [hash, {distance: child}]
+        self.size = 0
+
+    def add(self, value):
+        if self.root is None:
+            self.root = [value, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Return (distance, hash) pairs within max_distance, closest first"""
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.append((distance, node[0]))
+            # Triangle inequality: only subtrees in this band can hold matches
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort()
+        return results
+
+class PerceptualIndex:
+    """Bounded index of descriptions by perceptual hash, for near-duplicate images"""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.tree = BKTree()
+        self.entries = OrderedDict()  # hash -> {variant: description}
+        self.hits = 0
+
+    def find(self, phash, variant, max_distance):
+        """Return the description of the closest stored image for this variant, or None"""
+        if not hash_has_detail(phash):
+            return None
+        for distance, candidate in self.tree.search(phash, max_distance):
+            descriptions = self.entries.get(candidate)
+            if descriptions and variant in descriptions:
+                self.entries.move_to_end(candidate)
+                self.hits += 1
+                return descriptions[variant]
+        return None
+
+    def add(self, phash, variant, description):
+        if not hash_has_detail(phash):
+            return
+        if phash not in self.entries:
+            self.entries[phash] = {}
+            self.tree.add(phash)
+        self.entries[phash][variant] = description
+        self.entries.move_to_end(phash)
+        if len(self.entries) > self.max_entries:
+            # BK-trees can't delete, so drop the oldest half and rebuild
+            while len(self.entries) > self.max_entries // 2:
+                self.entries.popitem(last=False)
+            self.tree = BKTree()
+            for stored in self.entries:
+                self.tree.add(stored)
+
+BATCH_SECTION_PATTERN = re.compile(r'^[#*\s]*Image\s+(\d+)\s*[:.\-]?[*\s]*:?', re.IGNORECASE | re.MULTILINE)
+
+def split_batch_response(text, count):
+    """Split a multi-image response into per-image sections, or None if there isn't one per image"""
+    matches = list(BATCH_SECTION_PATTERN.finditer(text))
+    sections = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        number = int(match.group(1))
+        body = text[match.end():following.start() if following else len(text)].strip()
+        if 1 <= number <= count and number not in sections and body:
+            sections[number] = body
+    if len(sections) != count:
+        return None
+    return [sections[number] for number in range(1, count + 1)]
+
+def to_signed64(value):
+    """Map an unsigned 64-bit hash into SQLite's signed INTEGER range"""
+    return value - (1 << 64) if value is not None and value >= (1 << 63) else value
+
+def to_unsigned64(value):
+    return value + (1 << 64) if value is not None and value < 0 else value
+
+class HistoryRecord:
+    """One image history entry in compact form: a float timestamp, interned names and an optionally compressed description"""
+
+    __slots__ = ('timestamp', 'context_data', 'channel', 'guild', 'channel_id', 'guild_id', 'phash')
+
+    def __init__(self, entry, compress=False):
+        self.timestamp = entry['timestamp'].timestamp()
+        context = entry['context']
+        self.context_data = zlib.compress(context.encode('utf-8')) if compress else context
+        # The same few channel and guild names repeat across thousands of entries, so share one copy
+        self.channel = sys.intern(entry['channel']) if entry.get('channel') else entry.get('channel')
+        self.guild = sys.intern(entry['guild']) if entry.get('guild') else entry.get('guild')
+        self.channel_id = entry.get('channel_id')
+        self.guild_id = entry.get('guild_id')
+        self.phash = entry.get('phash')
+
+    @property
+    def context(self):
+        if isinstance(self.context_data, bytes):
+            return zlib.decompress(self.context_data).decode('utf-8')
+        return self.context_data
+
+    def size(self):
+        """Approximate bytes this record holds on its own (interned names are shared, so not counted)"""
+        return sys.getsizeof(self) + sys.getsizeof(self.context_data)
+
+    def to_entry(self):
+        return {
+            'timestamp': datetime.fromtimestamp(self.timestamp, tz=timezone.utc),
+            'context': self.context,
+            'channel': self.channel,
+            'guild': self.guild,
+            'channel_id': self.channel_id,
+            'guild_id': self.guild_id,
+            'phash': self.phash
+        }
+
+class MemoryHistoryStore:
+    """In-process image history, used when no history database is configured
+
+    Records are kept compact and under global entry and byte budgets. When a budget is exceeded the
+    least recently active users lose their oldest records first, and expired records are swept out
+    periodically so users who never come back don't hold memory for months.
+    """
+
+    def __init__(self, max_per_user=50, retention_days=90, max_entries=20000, max_bytes=32 * 1024 * 1024,
+                 compress=False, sweep_interval=3600):
+        self.max_per_user = max_per_user
+        self.retention = timedelta(days=retention_days)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.sweep_interval = sweep_interval
+        self.entries = OrderedDict()  # user_id -> list of HistoryRecord, oldest first; least recently active user first
+        self.total_entries = 0
+        self.total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self.last_sweep = time.monotonic()
+
+    def _cutoff(self):
+        return (datetime.now(timezone.utc) - self.retention).timestamp()
+
+    def _drop(self, user_id, records):
+        """Remove records from a user's list and the totals"""
+        for record in records:
+            self.total_entries -= 1
+            self.total_bytes -= record.size()
+        if not self.entries.get(user_id):
+            self.entries.pop(user_id, None)
+
+    def _live(self, user_id):
+        records = self.entries.get(user_id)
+        if not records:
+            return []
+        cutoff = self._cutoff()
+        stale = 0
+        while stale < len(records) and records[stale].timestamp < cutoff:
+            stale += 1
+        if stale:
+            dropped = records[:stale]
+            del records[:stale]
+            self.expired += stale
+            self._drop(user_id, dropped)
+        return records
+
+    def _sweep(self):
+        """Drop expired records of every user"""
+        self.last_sweep = time.monotonic()
+        for user_id in list(self.entries):
+            self._live(user_id)
+
+    def _evict(self):
+        """Drop the least recently active users' oldest records until both budgets are met"""
+        while self.entries and (self.total_entries > self.max_entries or self.total_bytes > self.max_bytes):
+            user_id, records = next(iter(self.entries.items()))
+            dropped = records.pop(0)
+            self.evicted += 1
+            self._drop(user_id, [dropped])
+
+    async def add(self, user_id, entry):
+        record = HistoryRecord(entry, compress=self.compress)
+        records = self.entries.setdefault(user_id, [])
+        self.entries.move_to_end(user_id)
+        records.append(record)
+        self.total_entries += 1
+        self.total_bytes += record.size()
+        if len(records) > self.max_per_user:
+            dropped = records[:-self.max_per_user]
+            del records[:-self.max_per_user]
+            self._drop(user_id, dropped)
+        if time.monotonic() - self.last_sweep >= self.sweep_interval:
+            self._sweep()
+        self._evict()
+
+    async def recent(self, user_id, limit=5):
+        """Return a user's latest history entries, newest first"""
+        records = self._live(user_id)
+        if records:
+            self.entries.move_to_end(user_id)
+        return [record.to_entry() for record in reversed(records[-limit:])]
+
+    async def count(self, user_id):
+        return len(self._live(user_id))
+
+    async def has_similar(self, user_id, phash, max_distance):
+        """Check whether a user's history already holds a near-duplicate of this image"""
+        if phash is None or not hash_has_detail(phash):
+            return False
+        return any(
+            record.phash is not None and hamming_distance(record.phash, phash) <= max_distance
+            for record in self._live(user_id)
+        )
+
+    def stats(self):
+        return {
+            'users': len(self.entries),
+            'entries': self.total_entries,
+            'bytes': self.total_bytes,
+            'evicted': self.evicted,
+            'expired': self.expired
+        }
+
+    async def close(self):
+        pass
+
+class SQLiteHistoryStore:
+    """Image history in SQLite, written in batches on a background thread"""
+
+    def __init__(self, path, max_per_user=50, retention_days=90, flush_interval=1.0, batch_size=100):
+        self.max_per_user = max_per_user
+        self.retention = timedelta(days=retention_days)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.flush_task = None
+        # One thread owns the connection, so database work is serialized and never blocks the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-db')
+        self.db = None
+        try:
+            self._open(path)
+        except sqlite3.Error:
+            if self.db is not None:
+                self.db.close()
+            self.executor.shutdown(wait=False)
+            raise
+
+    def _open(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS image_history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user_id INTEGER NOT NULL, "
+            "guild_id INTEGER, "
+            "channel_id INTEGER, "
+            "guild_name TEXT, "
+            "channel_name TEXT, "
+            "timestamp REAL NOT NULL, "
+            "context TEXT NOT NULL, "
+            "phash INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_history_user ON image_history (user_id, timestamp)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_history_guild ON image_history (guild_id, timestamp)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_history_channel ON image_history (channel_id, timestamp)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON image_history (timestamp)")
+        self.db.commit()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def add(self, user_id, entry):
+        self.pending.append((
+            user_id,
+            entry.get('guild_id'),
+            entry.get('channel_id'),
+            entry['guild'],
+            entry['channel'],
+            entry['timestamp'].timestamp(),
+            entry['context'],
+            to_signed64(entry.get('phash'))
+        ))
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all pending entries in one transaction"""
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            await self._run(self._write, rows)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing image history: {e}")
+
+    def _write(self, rows):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO image_history "
+                "(user_id, guild_id, channel_id, guild_name, channel_name, timestamp, context, phash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            # Enforce retention: per-user entry limit and maximum age
+            for user_id in {row[0] for row in rows}:
+                self.db.execute(
+                    "DELETE FROM image_history WHERE user_id = ? AND id NOT IN ("
+                    "SELECT id FROM image_history WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?)",
+                    (user_id, user_id, self.max_per_user)
+                )
+            self.db.execute("DELETE FROM image_history WHERE timestamp < ?", (self._cutoff(),))
+
+    def _cutoff(self):
+        return (datetime.now(timezone.utc) - self.retention).timestamp()
+
+    async def recent(self, user_id, limit=5):
+        """Return a user's latest history entries, newest first"""
+        await self.flush()
+        rows = await self._run(self._query, (
+            "SELECT timestamp, context, channel_name, guild_name, phash FROM image_history "
+            "WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?"
+        ), (user_id, self._cutoff(), limit))
+        return [
+            {
+                'timestamp': datetime.fromtimestamp(row[0], tz=timezone.utc),
+                'context': row[1],
+                'channel': row[2],
+                'guild': row[3],
+                'phash': to_unsigned64(row[4])
+            }
+            for row in rows
+        ]
+
+    async def count(self, user_id):
+        await self.flush()
+        rows = await self._run(
+            self._query,
+            "SELECT COUNT(*) FROM image_history WHERE user_id = ? AND timestamp >= ?",
+            (user_id, self._cutoff())
+        )
+        return rows[0][0]
+
+    async def has_similar(self, user_id, phash, max_distance):
+        """Check whether a user's history already holds a near-duplicate of this image"""
+        if phash is None or not hash_has_detail(phash):
+            return False
+        await self.flush()
+        rows = await self._run(
+            self._query,
+            "SELECT phash FROM image_history WHERE user_id = ? AND timestamp >= ? AND phash IS NOT NULL",
+            (user_id, self._cutoff())
+        )
+        return any(hamming_distance(to_unsigned64(row[0]), phash) <= max_distance for row in rows)
+
+    def _query(self, sql, params):
+        return self.db.execute(sql, params).fetchall()
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self._run(self.db.close)
+        self.executor.shutdown(wait=False)
+
+ImageRef = namedtuple('ImageRef', ['message_id', 'url', 'timestamp', 'attachment'])  # attachment is None for links
+# What read_attachment needs of an indexed attachment, without keeping discord.py's object alive
+AttachmentRef = namedtuple('AttachmentRef', ['id', 'filename', 'url', 'size', 'proxy_url', 'width', 'height', 'content_type'])
+
+class RecentImageIndex:
+    """Bounded index of the most recent images each author posted in each channel"""
+
+    def __init__(self, per_author=3, max_authors=50000):
+        self.per_author = per_author
+        self.max_authors = max_authors
+        self.entries = OrderedDict()  # (channel_id, author_id) -> list of ImageRef, oldest first
+        self.backfilled = OrderedDict()  # channel_id -> how many history messages have been indexed
+
+    def add(self, channel_id, author_id, ref):
+        key = (channel_id, author_id)
+        refs = self.entries.get(key)
+        if refs is None:
+            refs = self.entries[key] = []
+        elif any(existing.message_id == ref.message_id for existing in refs):
+            return
+        # Backfilled history arrives newest first, so keep each list sorted by time
+        position = len(refs)
+        while position and refs[position - 1].timestamp > ref.timestamp:
+            position -= 1
+        refs.insert(position, ref)
+        del refs[:-self.per_author]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_authors:
+            (evicted_channel, _), _ = self.entries.popitem(last=False)
+            # The channel's history has to be scanned again to find what was just forgotten
+            self.backfilled.pop(evicted_channel, None)
+
+    def lookup(self, channel_id, author_id):
+        """Return an author's indexed images in a channel, newest first"""
+        refs = self.entries.get((channel_id, author_id))
+        return list(reversed(refs)) if refs else []
+
+    def discard(self, channel_id, author_id, message_id):
+        refs = self.entries.get((channel_id, author_id))
+        if refs:
+            refs[:] = [ref for ref in refs if ref.message_id != message_id]
+
+    def backfilled_depth(self, channel_id):
+        return self.backfilled.get(channel_id, 0)
+
+    def mark_backfilled(self, channel_id, depth):
+        self.backfilled[channel_id] = max(depth, self.backfilled_depth(channel_id))
+        self.backfilled.move_to_end(channel_id)
+        while len(self.backfilled) > self.max_authors:
+            self.backfilled.popitem(last=False)
+
+def current_rss_bytes():
+    """The process's resident memory in bytes, or None where it can't be read"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a collection of numbers, or None if it's empty"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+class Histogram:
+    """Cumulative-bucket histogram that also keeps recent samples for percentiles"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=1024)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+        self.samples.append(value)
+
+class Metrics:
+    """In-process counters, gauges and histograms, exported in Prometheus text format"""
+
+    def __init__(self, prefix='blindbot', buckets=METRICS_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_counter(self, name, value, **labels):
+        """Record the current total of a counter that another component keeps"""
+        self.counters[self._key(name, labels)] = value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def add_gauge(self, name, amount, **labels):
+        key = self._key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a pipeline stage, tracking in-flight work and errors by cause"""
+        self.add_gauge('stage_in_flight', 1, stage=name)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc('errors_total', stage=name, cause=type(e).__name__)
+            raise
+        finally:
+            self.add_gauge('stage_in_flight', -1, stage=name)
+            self.observe('stage_seconds', time.perf_counter() - started, stage=name)
+
+    def percentiles(self, name, points=(50, 95, 99), **labels):
+        """Return {point: value} from a histogram's recent samples, or None if it has none"""
+        histogram = self.histograms.get(self._key(name, labels))
+        if histogram is None or not histogram.samples:
+            return None
+        return {point: percentile(histogram.samples, point) for point in points}
+
+    def stage_summary(self):
+        """Return (stage, count, {point: seconds}) for every timed stage"""
+        summary = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name == 'stage_seconds' and histogram.samples:
+                stage = dict(labels)['stage']
+                summary.append((stage, histogram.count, self.percentiles(name, stage=stage)))
+        return summary
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+            seen = set()
+            for (name, labels), value in sorted(values.items()):
+                full_name = f"{self.prefix}_{name}"
+                if name not in seen:
+                    lines.append(f"# TYPE {full_name} {kind}")
+                    seen.add(name)
+                lines.append(f"{full_name}{self._format_labels(labels)} {value}")
+        seen = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            full_name = f"{self.prefix}_{name}"
+            if name not in seen:
+                lines.append(f"# TYPE {full_name} histogram")
+                seen.add(name)
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{full_name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{full_name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{full_name}_sum{self._format_labels(labels)} {histogram.total}")
+            lines.append(f"{full_name}_count{self._format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+class LoopLagMonitor:
+    """Samples event loop scheduling delay, and logs what the loop is running when it stalls
+
+    A task on the loop sleeps for a fixed interval and records how late it wakes up. A watchdog thread
+    checks that task's heartbeat, and when the loop has been stuck past the threshold it logs the stack
+    of the loop's thread and the task that was running, while it is still blocked.
+    """
+
+    def __init__(self, metrics, interval=0.5, threshold=0.25):
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.loop = None
+        self.loop_thread_id = None
+        self.task = None
+        self.stopped = threading.Event()
+        self.watchdog = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self._sample())
+        self.watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self.heartbeat = now
+            self.max_lag = max(self.max_lag, lag)
+            self.metrics.observe('event_loop_lag_seconds', lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval / 2):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat < self.interval + self.threshold or reported == heartbeat:
+                continue
+            # Report each stall once, with the stack as it is right now
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            task = asyncio.current_task(self.loop)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(no stack)\n'
+            name = f"{task.get_name()} running {task.get_coro().__qualname__}" if task is not None else 'no task (a callback)'
+            logger.warning(f"Event loop stalled for over {self.threshold * 1000:.0f}ms in {name}:\n{stack.rstrip()}")
+
+class ProgressiveDM:
+    """A DM that is edited in place as a streamed description grows
+
+    update() only records the latest text, so the analysis job streaming it never waits on Discord. A flush task
+    renders it at most once per interval, sending and editing through the recipient's DMDelivery queue. Nothing is
+    sent before the optional after task, which queues another DM that has to come first, is done.
+    """
+
+    def __init__(self, delivery, user, title, interval=1.5, after=None):
+        self.delivery = delivery
+        self.user = user
+        self.title = title
+        self.interval = interval
+        self.after = after
+        self.text = ''
+        self.final = False
+        self.messages = []  # messages sent so far, one per part
+        self.shown = []  # content of each of them
+        self.last_flush = 0.0
+        self.finished = asyncio.Event()  # cuts the wait between flushes short for the final text
+        self.flusher = None
+
+    @property
+    def started(self):
+        return bool(self.text) or bool(self.messages)
+
+    async def update(self, text, final=False):
+        """Record the text so far; it is shown by the flush task
+
+        Empty text means the stream is starting over, after a retry, and replaces whatever was shown.
+        """
+        self.text = text
+        self.final = final
+        if not text and not final and not self.messages:
+            return
+        if final:
+            self.finished.set()
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush())
+
+    async def finish(self, text):
+        """Show the final text and wait until it has been delivered"""
+        await self.update(text, final=True)
+        await self.flusher
+
+    async def fail(self, note="*(The description stopped here because something went wrong. Please try again.)*"):
+        """End a stream that broke off, so what was shown doesn't look like it's still being written"""
+        if not self.started or self.final:
+            return
+        text = self.text.rstrip()
+        await self.finish(f"{text}\n\n{note}" if text else note)
+
+    def render(self, text, final):
+        """Split the text so far into message contents, freezing full parts at sentence or word boundaries"""
+        contents = []
+        offset = 0
+        while True:
+            if not contents:
+                header = f"**{self.title}:**\n\n"
+            else:
+                header = f"**Continued... (Part {len(contents) + 1}):**\n\n"
+            segment = text[offset:]
+            room = DM_MESSAGE_LIMIT - len(header) - len(" …")
+            if len(segment) <= room:
+                contents.append(header + segment + ("" if final else " …"))
+                return contents
+            cut = find_split_point(segment, room)
+            contents.append(header + segment[:cut])
+            offset += cut
+
+    async def _flush(self):
+        if self.after is not None:
+            # Waits without raising, the after task failing or being cancelled doesn't stop this DM
+            await asyncio.wait([self.after])
+        rendered = None
+        while (self.text, self.final) != rendered:
+            if not self.final:
+                try:
+                    await asyncio.wait_for(self.finished.wait(), max(self.last_flush + self.interval - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            rendered = (self.text, self.final)
+            self.last_flush = time.monotonic()
+            contents = self.render(*rendered)
+            # A retried stream can end up shorter than the one it replaced, so say what's left over isn't part of it
+            for index in range(len(contents), len(self.messages)):
+                note = "*(The description ends in an earlier part.)*" if rendered[1] else "*(Being rewritten…)*"
+                contents.append(f"**Continued... (Part {index + 1}):**\n\n{note}")
+            for index, content in enumerate(contents):
+                if index < len(self.shown) and self.shown[index] == content:
+                    continue
+                try:
+                    if index < len(self.messages):
+                        await self.delivery.deliver(self.user, content, message=self.messages[index])
+                        self.shown[index] = content
+                    else:
+                        self.messages.append(await self.delivery.deliver(self.user, content))
+                        self.shown.append(content)
+                except discord.HTTPException as e:
+                    logger.warning(f"Could not update streamed DM for {self.user}: {e}")
+                    break
+
+class StatusMessage:
+    """One channel message per request, edited as the request moves through its stages"""
+
+    def __init__(self, channel, trigger, reactions_only=False, interval=1.0, on_error=None):
+        self.channel = channel
+        self.trigger = trigger  # message that made the request, for reactions
+        self.reactions_only = reactions_only
+        self.interval = interval
+        self.on_error = on_error  # called with the failure text when there is no status message to show it
+        self.message = None
+        self.shown = None
+        self.pending = None
+        self.last_write = time.monotonic()  # the first post waits an interval too, in case we finish before then
+        self.flush_task = None
+        self.writing = False
+
+    async def update(self, text):
+        """Show a new stage, coalesced with any other changes in the same interval"""
+        self.pending = text
+        if self.reactions_only and self.shown is not None:
+            return
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text=None, success=True):
+        """Show the outcome right away, defaulting to the latest stage's text"""
+        while self.flush_task is not None:
+            if self.writing:
+                # Let an edit that's already on its way land first, so we never post twice
+                await asyncio.gather(self.flush_task, return_exceptions=True)
+            else:
+                self.flush_task.cancel()
+                self.flush_task = None
+        text = text or self.pending
+        try:
+            if self.reactions_only:
+                await self.trigger.add_reaction('✅' if success else '❌')
+                if not success and self.on_error is not None and text:
+                    await self.on_error(text)
+                return
+            if text:
+                await self._write(text)
+            if success:
+                await self.trigger.add_reaction('✅')
+        except discord.HTTPException as e:
+            logger.warning(f"Could not finish status in channel {self.channel.id}: {e}")
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(self.interval - (time.monotonic() - self.last_write), 0))
+        self.writing = True
+        try:
+            if self.reactions_only:
+                # Still working, one reaction stands in for every stage update
+                await self.trigger.add_reaction('👀')
+                self.shown = self.pending
+            else:
+                await self._write(self.pending)
+        except discord.HTTPException as e:
+            logger.warning(f"Could not update status in channel {self.channel.id}: {e}")
+            return
+        finally:
+            self.writing = False
+            self.flush_task = None
+        # A stage that changed while we were writing gets its own coalesced edit
+        if not self.reactions_only and self.pending != self.shown:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _write(self, text):
+        if text == self.shown:
+            return
+        if self.message is None:
+            self.message = await self.channel.send(text)
+        else:
+            await self.message.edit(content=text)
+        self.shown = text
+        self.last_write = time.monotonic()
+
+def find_split_point(text, room):
+    """Index to split text at so the first part fits in room, preferring paragraph, sentence and then word breaks"""
+    if len(text) <= room:
+        return len(text)
+    for separator in ('\n\n', '\n', '. ', '! ', '? ', ' '):
+        cut = text.rfind(separator, 0, room)
+        # Don't leave a message half empty just to end it on a nicer break
+        if cut >= room // 2:
+            return cut + len(separator)
+    cut = text.rfind(' ', 0, room)
+    return cut + 1 if cut > 0 else room
+
+class DMDelivery:
+    """Per-recipient DM queues that pack text into as few messages as possible and retry rate-limited sends"""
+
+    def __init__(self, use_embeds=False, max_attempts=5):
+        self.use_embeds = use_embeds
+        self.max_attempts = max_attempts
+        self.queues = {}  # user_id -> deque of [user, kwargs, future, attempts, message to edit or None]
+        self.tasks = {}  # user_id -> task draining that queue
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def pack(self, title, text):
+        """Split a titled text into message payloads at natural breaks"""
+        text = text.strip()
+        payloads = []
+        part = 1
+        while True:
+            if self.use_embeds:
+                cut = find_split_point(text, EMBED_DESCRIPTION_LIMIT)
+                embed_title = title if part == 1 else f"{title} (continued)"
+                payloads.append({'embed': discord.Embed(title=embed_title[:256], description=text[:cut].rstrip(), color=0x0099ff)})
+            else:
+                header = f"**{title}:**\n\n" if part == 1 else f"**Continued... (Part {part}):**\n\n"
+                cut = find_split_point(text, DM_MESSAGE_LIMIT - len(header))
+                payloads.append({'content': header + text[:cut].rstrip()})
+            text = text[cut:].lstrip()
+            if not text:
+                return payloads
+            part += 1
+
+    def send(self, user, title, text):
+        """Queue a titled text for a user, returning a future that finishes once every part is delivered"""
+        return asyncio.gather(*[self.deliver(user, **payload) for payload in self.pack(title, text)])
+
+    def deliver(self, user, content=None, embed=None, message=None):
+        """Queue one DM, or an edit of one already sent, behind anything waiting for the same user
+
+        Returns a future for the sent or edited message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        kwargs = {'content': content} if embed is None else {'content': content, 'embed': embed}
+        self.queues.setdefault(user.id, deque()).append([user, kwargs, future, 0, message])
+        if user.id not in self.tasks:
+            self.tasks[user.id] = asyncio.create_task(self._drain(user.id))
+        return future
+
+    async def _drain(self, user_id):
+        queue = self.queues[user_id]
+        try:
+            while queue:
+                item = queue[0]
+                user, kwargs, future, target = item[0], item[1], item[2], item[4]
+                if future.done():
+                    queue.popleft()
+                    continue
+                try:
+                    if target is not None:
+                        message = await target.edit(**kwargs)
+                    else:
+                        message = await user.send(**kwargs)
+                except discord.HTTPException as e:
+                    item[3] += 1
+                    if (e.status == 429 or e.status >= 500) and item[3] < self.max_attempts:
+                        # Only this recipient's queue waits, everything else keeps going
+                        self.retried += 1
+                        wait = retry_after_seconds(e, default=min(0.5 * 2 ** item[3], 30.0))
+                        logger.warning(f"DM to {user} failed with {e.status}, retrying in {wait:.1f}s")
+                        await asyncio.sleep(wait)
+                        continue
+                    queue.popleft()
+                    self.failed += 1
+                    future.set_exception(e)
+                else:
+                    queue.popleft()
+                    self.sent += 1
+                    future.set_result(message)
+        finally:
+            del self.tasks[user_id]
+            # Nothing left to send them if we were cancelled
+            for item in queue:
+                if not item[2].done():
+                    item[2].cancel()
+            del self.queues[user_id]
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+class QueueFullError(Exception):
+    """Raised when the analysis queue is full and a new job is turned away"""
+    pass
+
+def retry_after_seconds(error, default=1.0):
+    """Read the Retry-After header from an API error, falling back to a default"""
+    if getattr(error, 'retry_after', None) is not None:
+        return max(float(error.retry_after), 0.0)
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return max(float(headers.get('retry-after', default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+class TokenBucket:
+    """Token bucket refilled continuously at a per-minute rate"""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount):
+        """Seconds until the given amount of tokens is available"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """Take tokens from the bucket, a negative amount refunds them"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds):
+        """Empty the bucket so nothing is let through for the given number of seconds"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class AnalysisScheduler:
+    """Bounded worker pool that runs analysis jobs fairly across guilds and users within API rate limits"""
+
+    def __init__(self, workers=4, max_queue=50, requests_per_minute=500, tokens_per_minute=30000,
+                 tokens_per_job=1500, rate_limit_errors=(), max_retries=2, background_workers=1,
+                 max_background=20):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.tokens_per_job = tokens_per_job
+        self.rate_limit_errors = rate_limit_errors
+        self.max_retries = max_retries
+        self.queues = OrderedDict()  # guild_id -> OrderedDict(user_id -> deque of jobs)
+        self.pending = 0
+        # Low-priority work only runs when nothing interactive is waiting
+        self.background = OrderedDict()  # key -> job
+        self.background_workers = background_workers
+        self.max_background = max_background
+        self.background_active = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.job_seconds = deque(maxlen=50)  # recent job durations, for wait estimates
+        self.wakeup = None
+        self.tasks = []
+
+    def start(self):
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # Anyone still waiting gets cancelled rather than hanging forever
+        for users in self.queues.values():
+            for jobs in users.values():
+                for job in jobs:
+                    job[1].cancel()
+        for job in self.background.values():
+            job[1].cancel()
+        self.queues.clear()
+        self.background.clear()
+        self.pending = 0
+
+    def submit(self, guild_id, user_id, job_factory):
+        """Queue a job, returning (future, queue position); raises QueueFullError when full"""
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(f"Analysis queue is full ({self.pending} jobs waiting)")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue([job_factory, future, guild_id, user_id, 0, None])
+        return future, self.pending
+
+    def submit_background(self, key, job_factory):
+        """Queue a low-priority job under a key, returning its future or None if it was turned away"""
+        if key in self.background or len(self.background) >= self.max_background:
+            return None
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.background[key] = [job_factory, future, None, None, 0, key]
+        self.wakeup.set()
+        return future
+
+    def promote(self, key, guild_id, user_id):
+        """Move a queued background job into the interactive queue once someone is waiting on it"""
+        job = self.background.pop(key, None)
+        if job is None:
+            return False
+        job[2], job[3], job[5] = guild_id, user_id, None
+        self._enqueue(job)
+        return True
+
+    def _enqueue(self, job, front=False):
+        users = self.queues.setdefault(job[2], OrderedDict())
+        jobs = users.setdefault(job[3], deque())
+        if front:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+        self.pending += 1
+        self.wakeup.set()
+
+    def _next_job(self):
+        # Round-robin over guilds, and over users within a guild, so nobody can starve the rest
+        guild_id, users = next(iter(self.queues.items()))
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self.queues.move_to_end(guild_id)
+        else:
+            del self.queues[guild_id]
+        self.pending -= 1
+        return job
+
+    def estimate_wait(self, position):
+        """Rough number of seconds before the job at this queue position starts"""
+        average = sum(self.job_seconds) / len(self.job_seconds) if self.job_seconds else 5.0
+        rounds = math.ceil(max(position - (self.workers - self.active), 0) / self.workers)
+        limit_delay = max(
+            self.request_bucket.delay_for(position),
+            self.token_bucket.delay_for(position * self.tokens_per_job)
+        )
+        return max(rounds * average, limit_delay)
+
+    def record_usage(self, total_tokens):
+        """Correct the token estimate for a finished job with its real usage"""
+        self.token_bucket.consume(total_tokens - self.tokens_per_job)
+
+    def _background_delay(self):
+        """Seconds until background work fits in the rate limits with room left for a full round of interactive jobs"""
+        return max(
+            self.request_bucket.delay_for(self.workers + 1),
+            self.token_bucket.delay_for(self.tokens_per_job * (self.workers + 1))
+        )
+
+    async def _worker(self):
+        while True:
+            if not self.pending:
+                if self.background and self.background_active < self.background_workers:
+                    delay = self._background_delay()
+                    if delay == 0:
+                        self.request_bucket.consume(1)
+                        self.token_bucket.consume(self.tokens_per_job)
+                        key, job = self.background.popitem(last=False)
+                        await self._run(job)
+                        continue
+                    # Wait for headroom, or for interactive work to show up
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Hold the job back until both the request and token budgets allow it
+            delay = max(self.request_bucket.delay_for(1), self.token_bucket.delay_for(self.tokens_per_job))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(self.tokens_per_job)
+
+            await self._run(self._next_job())
+
+    async def _run(self, job):
+        job_factory, future, background = job[0], job[1], job[5] is not None
+        if future.done():
+            return
+
+        self.active += 1
+        if background:
+            self.background_active += 1
+        started = time.monotonic()
+        try:
+            result = await job_factory()
+        except self.rate_limit_errors as e:
+            # Back off everyone, then put the job back at the front of its queue
+            self.rate_limited += 1
+            wait = retry_after_seconds(e)
+            logger.warning(f"Rate limited by the API, pausing analysis for {wait:.1f}s")
+            self.request_bucket.pause(wait)
+            self.token_bucket.pause(wait)
+            job[4] += 1
+            if job[4] > self.max_retries:
+                if not future.done():
+                    future.set_exception(e)
+            elif background:
+                self.background[job[5]] = job
+                self.background.move_to_end(job[5], last=False)
+            else:
+                self._enqueue(job, front=True)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.completed += 1
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.active -= 1
+            if background:
+                self.background_active -= 1
+                # Let idle workers pick up the next background job
+                self.wakeup.set()
+            self.job_seconds.append(time.monotonic() - started)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that keeps failing"""
+    pass
+
+class CircuitBreaker:
+    """Stops calls after repeated failures, then lets a single trial call through once a cooldown has passed"""
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go ahead"""
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.trial_running):
+            raise CircuitOpenError("The vision API is failing, not calling it for now")
+
+    def begin(self):
+        """Check and claim the trial call when half-open"""
+        self.check()
+        if self.state == 'half-open':
+            self.trial_running = True
 
-def signal_handler(signum, frame):
-    """Handle shutdown signals gracefully"""
-    logger.info(f"Received signal {signum}, initiating graceful shutdown...")
-    # Exit gracefully
-    sys.exit(0)
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
 
-# Register signal handlers for graceful shutdown
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_running:
+                self.trips += 1
+                logger.warning(f"Opening circuit breaker after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+    def release(self):
+        """Give back a trial call that ended without telling us anything about upstream health"""
+        self.trial_running = False
+
+class ResilientCaller:
+    """Runs API calls with deadlines, jittered retries, optional hedging and a circuit breaker"""
+
+    def __init__(self, retryable_errors=(), attempt_timeout=45.0, total_timeout=120.0, max_attempts=3,
+                 backoff_base=0.5, backoff_max=10.0, hedge=False, hedge_min_samples=20, breaker=None,
+                 on_extra_call=None):
+        self.retryable_errors = tuple(retryable_errors) + (asyncio.TimeoutError,)
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.on_extra_call = on_extra_call  # charges retries and hedges against the rate limits
+        self.attempt_seconds = deque(maxlen=200)  # recent successful attempts, for the hedge delay
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, the p95 of recent attempts, or None while there's too little data"""
+        if not self.hedge or len(self.attempt_seconds) < self.hedge_min_samples:
+            return None
+        return percentile(self.attempt_seconds, 95)
+
+    def backoff(self, attempt, error):
+        """Full-jitter exponential backoff, unless the error says exactly how long to wait"""
+        jittered = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return retry_after_seconds(error, default=jittered)
+
+    async def call(self, call_factory, hedge=True, retry_timeouts=True):
+        """Run call_factory() until it succeeds, a non-retryable error occurs or the deadline passes
+
+        Pass retry_timeouts=False for calls that keep running after they time out, so each retry
+        doesn't pile more work on top of the one still going.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        for attempt in range(self.max_attempts):
+            self.breaker.begin()
+            if attempt:
+                self.retries += 1
+                if self.on_extra_call is not None:
+                    self.on_extra_call()
+            remaining = deadline - time.monotonic()
+            try:
+                result = await asyncio.wait_for(
+                    self._attempt(call_factory, self.hedge_delay() if hedge else None),
+                    min(self.attempt_timeout, remaining)
+                )
+            except self.retryable_errors as e:
+                self.breaker.record_failure()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                delay = self.backoff(attempt, e)
+                if attempt + 1 >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    raise
+                if isinstance(e, asyncio.TimeoutError) and not retry_timeouts:
+                    raise
+                logger.warning(f"Vision call attempt {attempt + 1} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Rate limits, bad requests and cancellation say nothing about upstream health
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _attempt(self, call_factory, hedge_delay):
+        started = time.monotonic()
+        first = asyncio.ensure_future(call_factory())
+        tasks = {first}
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    # The first attempt is in its slow tail, race a second one against it
+                    self.hedges += 1
+                    if self.on_extra_call is not None:
+                        self.on_extra_call()
+                    tasks.add(asyncio.ensure_future(call_factory()))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        self.attempt_seconds.append(time.monotonic() - started)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks | {first}:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # a losing attempt's error is expected, don't log it as unretrieved
+
+class SingleFlight:
+    """Share one in-progress call between concurrent callers asking for the same key"""
+
+    def __init__(self):
+        self.calls = {}  # key -> task
+        self.shared = 0
+
+    async def run(self, key, coro_factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+        # Shield so one caller giving up doesn't cancel the work for everyone else
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
 
 class ImageContextBot(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.openai_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Retries happen in ResilientCaller, so the client itself doesn't retry
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_retries=0,
+            timeout=OPENAI_ATTEMPT_TIMEOUT
+        )
         # Track user image history
-        self.user_image_history = {}  # user_id -> list of image data
+        self.image_history = None
+        if HISTORY_DB_PATH:
+            try:
+                self.image_history = SQLiteHistoryStore(
+                    HISTORY_DB_PATH,
+                    max_per_user=HISTORY_MAX_PER_USER,
+                    retention_days=HISTORY_RETENTION_DAYS,
+                    flush_interval=HISTORY_FLUSH_INTERVAL,
+                    batch_size=HISTORY_BATCH_SIZE
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Could not open image history database {HISTORY_DB_PATH}, keeping history in memory: {e}")
+        if self.image_history is None:
+            self.image_history = MemoryHistoryStore(
+                max_per_user=HISTORY_MAX_PER_USER,
+                retention_days=HISTORY_RETENTION_DAYS,
+                max_entries=HISTORY_MEMORY_MAX_ENTRIES,
+                max_bytes=HISTORY_MEMORY_MAX_BYTES,
+                compress=HISTORY_COMPRESS,
+                sweep_interval=HISTORY_SWEEP_INTERVAL
+            )
+        # Cache descriptions so repeated images don't cost another API call
+        self.description_cache = DescriptionCache(
+            max_entries=DESCRIPTION_CACHE_SIZE,
+            ttl=DESCRIPTION_CACHE_TTL,
+            db_path=DESCRIPTION_CACHE_DB or None
+        )
+        # Match re-uploaded, recompressed or resized copies of images we've already described
+        self.perceptual_index = PerceptualIndex(max_entries=PHASH_INDEX_SIZE)
+        # Shared download session, created once the event loop is running
+        self.http_session = None
+        # Session for API uploads sent without the SDK, kept apart from downloads
+        self.api_session = None
+        # Recent images per (channel, author), kept current from on_message
+        self.recent_images = RecentImageIndex(
+            per_author=RECENT_IMAGES_PER_AUTHOR,
+            max_authors=RECENT_IMAGE_INDEX_SIZE
+        )
+        # Per-stage latency, throughput and error metrics
+        self.metrics = Metrics()
+        self.metrics_runner = None
+        # Outgoing DMs, packed into few messages and queued per recipient
+        self.dm_delivery = DMDelivery(use_embeds=DM_USE_EMBEDS, max_attempts=DM_SEND_ATTEMPTS)
+        # Deduplicate concurrent scans, downloads and analyses of the same image
+        self.inflight = SingleFlight()
+        # Queue OpenAI calls so bursts stay within rate limits and no guild starves the others
+        self.scheduler = AnalysisScheduler(
+            workers=ANALYSIS_WORKERS,
+            max_queue=ANALYSIS_QUEUE_DEPTH,
+            requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+            tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+            tokens_per_job=ANALYSIS_TOKENS_PER_REQUEST,
+            rate_limit_errors=(openai.RateLimitError, UpstreamRateLimitError),
+            max_retries=ANALYSIS_RATE_LIMIT_RETRIES,
+            max_background=PREFETCH_QUEUE_DEPTH
+        )
+        # Deadlines, retries, hedging and a circuit breaker around every vision call
+        self.resilience = ResilientCaller(
+            retryable_errors=(openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+                              UpstreamRetryableError),
+            attempt_timeout=OPENAI_ATTEMPT_TIMEOUT,
+            total_timeout=OPENAI_TOTAL_TIMEOUT,
+            max_attempts=OPENAI_MAX_ATTEMPTS,
+            backoff_base=OPENAI_BACKOFF_BASE,
+            backoff_max=OPENAI_BACKOFF_MAX,
+            hedge=OPENAI_HEDGE,
+            hedge_min_samples=OPENAI_HEDGE_MIN_SAMPLES,
+            breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN),
+            on_extra_call=self.charge_extra_call
+        )
+        # Channels whose images are described before anyone asks, within an hourly budget
+        self.prefetch_channels = set(PREFETCH_CHANNEL_IDS)
+        # Per-guild routing policy overrides
+        self.guild_policies = dict(ROUTING_GUILD_POLICIES)
+        self.prefetch_budget = TokenBucket(PREFETCH_PER_HOUR / 60, capacity=max(PREFETCH_PER_HOUR, 1))
+        self.background_tasks = set()
+        # Hashing, encoding and image decoding run here so they don't block the event loop
+        if CPU_EXECUTOR == 'process':
+            self.cpu_executor = ProcessPoolExecutor(
+                max_workers=CPU_EXECUTOR_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        else:
+            self.cpu_executor = ThreadPoolExecutor(max_workers=CPU_EXECUTOR_WORKERS, thread_name_prefix='cpu')
+        self.loop_monitor = LoopLagMonitor(self.metrics, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD)
+        # Analysis worker processes, started in cog_load when ANALYSIS_WORKER_PROCESSES is set
+        self.analysis_pool = None
+        self.analysis_pool_generation = 0  # bumped whenever the pool is replaced
+        self.analysis_pool_lock = asyncio.Lock()
+    
+    async def cog_load(self):
+        await self.get_http_session()
+        self.scheduler.start()
+        if ANALYSIS_WORKER_PROCESSES > 0:
+            await self.start_analysis_pool()
+        if LOOP_LAG_INTERVAL > 0:
+            self.loop_monitor.start()
+        if METRICS_PORT:
+            await self.start_metrics_server()
+    
+    async def cog_unload(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        for task in list(self.background_tasks):
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await self.scheduler.stop()
+        if self.analysis_pool is not None:
+            self.analysis_pool.shutdown(wait=False, cancel_futures=True)
+            self.analysis_pool = None
+        await self.loop_monitor.stop()
+        self.cpu_executor.shutdown(wait=False, cancel_futures=True)
+        await self.dm_delivery.close()
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+        if self.api_session is not None and not self.api_session.closed:
+            await self.api_session.close()
+        self.api_session = None
+        self.description_cache.close()
+        await self.image_history.close()
+    
+    async def start_analysis_pool(self):
+        """Start the analysis worker processes, each with its own OpenAI client"""
+        # Spawn rather than fork, the gateway process has threads and an event loop a fork would copy mid-flight
+        context = multiprocessing.get_context('spawn')
+        self.analysis_pool_generation += 1
+        self.analysis_pool = ProcessPoolExecutor(
+            max_workers=ANALYSIS_WORKER_PROCESSES,
+            mp_context=context,
+            initializer=init_analysis_worker,
+            initargs=(
+                self.openai_client.api_key, str(self.openai_client.base_url), OPENAI_ATTEMPT_TIMEOUT,
+                context.Barrier(ANALYSIS_WORKER_PROCESSES)
+            )
+        )
+        # Wait for the workers to start up so the first requests don't spend their deadline on it
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        # Processes are started on demand, one per submitted job, so submit one per worker
+        await asyncio.gather(*[
+            loop.run_in_executor(self.analysis_pool, os.getpid) for _ in range(ANALYSIS_WORKER_PROCESSES)
+        ])
+        logger.info(f"Started {ANALYSIS_WORKER_PROCESSES} analysis worker processes in {time.monotonic() - started:.1f}s")
+    
+    async def restart_analysis_pool(self, generation):
+        """Replace a broken analysis pool, unless another request has already replaced that generation"""
+        async with self.analysis_pool_lock:
+            if generation != self.analysis_pool_generation or self.analysis_pool is None:
+                return
+            logger.error("An analysis worker process died, restarting the pool")
+            self.analysis_pool.shutdown(wait=False, cancel_futures=True)
+            try:
+                await self.start_analysis_pool()
+            except Exception as e:
+                logger.error(f"Could not restart the analysis pool: {e}")
+    
+    async def start_metrics_server(self):
+        """Serve metrics in Prometheus text format on a local port"""
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics_request)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+            await runner.cleanup()
+            return
+        self.metrics_runner = runner
+        logger.info(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    
+    async def handle_metrics_request(self, request):
+        self.update_sampled_metrics()
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8')
+    
+    def update_sampled_metrics(self):
+        """Copy totals and point-in-time values from the cog's components into counters and gauges"""
+        cache_stats = self.description_cache.stats()
+        self.metrics.set_gauge('description_cache_entries', cache_stats['entries'])
+        self.metrics.set_counter('description_cache_lookups_total', cache_stats['hits'], result='memory_hit')
+        self.metrics.set_counter('description_cache_lookups_total', cache_stats['disk_hits'], result='disk_hit')
+        self.metrics.set_counter('description_cache_lookups_total', cache_stats['misses'], result='miss')
+        self.metrics.set_counter('perceptual_index_hits_total', self.perceptual_index.hits)
+        self.metrics.set_gauge('analysis_queue_waiting', self.scheduler.pending)
+        self.metrics.set_gauge('analysis_queue_running', self.scheduler.active)
+        self.metrics.set_counter('analysis_jobs_rejected_total', self.scheduler.rejected)
+        self.metrics.set_counter('analysis_jobs_rate_limited_total', self.scheduler.rate_limited)
+        self.metrics.set_counter('coalesced_requests_total', self.inflight.shared)
+        self.metrics.set_counter('vision_call_retries_total', self.resilience.retries)
+        self.metrics.set_counter('vision_call_timeouts_total', self.resilience.timeouts)
+        self.metrics.set_counter('vision_call_hedges_total', self.resilience.hedges)
+        self.metrics.set_counter('vision_call_hedge_wins_total', self.resilience.hedge_wins)
+        self.metrics.set_gauge('circuit_breaker_open', int(self.resilience.breaker.state != 'closed'))
+        self.metrics.set_counter('circuit_breaker_trips_total', self.resilience.breaker.trips)
+        if isinstance(self.image_history, MemoryHistoryStore):
+            history = self.image_history.stats()
+            self.metrics.set_gauge('history_entries', history['entries'])
+            self.metrics.set_gauge('history_bytes', history['bytes'])
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.metrics.set_gauge('process_resident_bytes', rss)
+        self.metrics.set_gauge('event_loop_max_lag_seconds', self.loop_monitor.max_lag)
+        self.metrics.set_counter('event_loop_stalls_total', self.loop_monitor.stalls)
+        self.metrics.set_counter('dm_messages_total', self.dm_delivery.sent, result='sent')
+        self.metrics.set_counter('dm_messages_total', self.dm_delivery.retried, result='retried')
+        self.metrics.set_counter('dm_messages_total', self.dm_delivery.failed, result='failed')
+    
+    async def get_http_session(self):
+        """Return the cog-wide download session, creating it on first use"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=DOWNLOAD_MAX_CONNECTIONS,
+                limit_per_host=DOWNLOAD_MAX_CONNECTIONS_PER_HOST,
+                keepalive_timeout=DOWNLOAD_KEEPALIVE,
+                ttl_dns_cache=DOWNLOAD_DNS_CACHE_TTL
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=DOWNLOAD_CONNECT_TIMEOUT,
+                sock_read=DOWNLOAD_READ_TIMEOUT
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={'User-Agent': 'BlindBot/1.0'}
+            )
+        return self.http_session
+    
+    async def get_api_session(self):
+        """Return the session for requests to the OpenAI API made without the SDK, creating it on first use
+
+        It has its own connection pool, so uploads don't queue behind image downloads for connections.
+        """
+        if self.api_session is None or self.api_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=max(ANALYSIS_WORKERS, 1) * 2,  # room for a retry or hedge next to every worker's call
+                keepalive_timeout=DOWNLOAD_KEEPALIVE,
+                ttl_dns_cache=DOWNLOAD_DNS_CACHE_TTL
+            )
+            self.api_session = aiohttp.ClientSession(connector=connector)
+        return self.api_session
+    
+    async def download_image(self, url, headers=None):
+        """Download an image, sharing the transfer with any concurrent request for the same URL"""
+        return await self.inflight.run(('download', url), lambda: self._download_image(url, headers))
+    
+    async def _download_image(self, url, headers=None):
+        """Stream an image over the shared session, returning the bytes or None if it isn't usable"""
+        session = await self.get_http_session()
+        async with session.get(url, headers=headers) as response:
+            if response.status != 200:
+                logger.error(f"Failed to download image: {response.status}")
+                self.metrics.inc('errors_total', stage='download', cause=f'http_{response.status}')
+                return None
+            
+            # Refuse oversized downloads before reading any of the body
+            if response.content_length is not None and response.content_length > DOWNLOAD_MAX_BYTES:
+                logger.warning(f"Skipping image of {response.content_length} bytes (limit {DOWNLOAD_MAX_BYTES})")
+                self.metrics.inc('errors_total', stage='download', cause='too_large')
+                return None
+            
+            # Large images go to a temporary file as they arrive, so growing a buffer and copying it out
+            # doesn't briefly need twice the image's size. Once the spool is past its in-memory size every
+            # write is disk I/O, so it runs in the default thread pool instead of on the event loop
+            loop = asyncio.get_running_loop()
+            with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES) as spool:
+                size = 0
+                head = b''
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > DOWNLOAD_SPOOL_BYTES:
+                        await loop.run_in_executor(None, spool.write, chunk)
+                    else:
+                        spool.write(chunk)
+                    if size > DOWNLOAD_MAX_BYTES:
+                        logger.warning(f"Aborted image download over {DOWNLOAD_MAX_BYTES} bytes")
+                        self.metrics.inc('errors_total', stage='download', cause='too_large')
+                        return None
+                    # Check the magic bytes as soon as we have them so non-images fail fast
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                        if len(head) >= 16 and sniff_image_type(head) is None:
+                            logger.warning(f"Aborted download, content is not an image ({response.content_type})")
+                            self.metrics.inc('errors_total', stage='download', cause='not_image')
+                            return None
+                
+                if len(head) < 16 and sniff_image_type(head) is None:
+                    logger.warning(f"Downloaded content is not an image ({response.content_type})")
+                    self.metrics.inc('errors_total', stage='download', cause='not_image')
+                    return None
+                self.metrics.inc('image_bytes_in_total', size)
+                spool.seek(0)
+                if size > DOWNLOAD_SPOOL_BYTES:
+                    return await loop.run_in_executor(None, spool.read)
+                return spool.read()
+    
+    async def read_attachment(self, attachment, headers=None):
+        """Read a Discord attachment, sharing the transfer with concurrent requests for it"""
+        return await self.inflight.run(('attachment', attachment.id), lambda: self._read_attachment(attachment, headers))
+    
+    async def _read_attachment(self, attachment, headers=None):
+        """Read a Discord attachment's bytes, through discord.py or the download pool"""
+        # Discord tells us the size up front, so oversized files are never fetched
+        if attachment.size > DOWNLOAD_MAX_BYTES:
+            logger.warning(f"Skipping attachment {attachment.filename} of {attachment.size} bytes (limit {DOWNLOAD_MAX_BYTES})")
+            return None
+        
+        # The model doesn't need more than a couple of megapixels, so let Discord shrink big images before we download them
+        rendition_url = proxy_rendition_url(attachment, ATTACHMENT_PROXY_MAX_SIDE)
+        if rendition_url is not None:
+            try:
+                image_data = await self.download_image(rendition_url, headers=headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.info(f"Could not fetch a resized {attachment.filename}: {e}")
+                image_data = None
+            if image_data is not None:
+                saved = max(attachment.size - len(image_data), 0)
+                self.metrics.inc('proxy_renditions_total', result='used')
+                self.metrics.inc('proxy_bytes_saved_total', saved)
+                logger.info(f"Fetched {attachment.filename} resized from {attachment.width}x{attachment.height}, {attachment.size} -> {len(image_data)} bytes")
+                return image_data
+            logger.info(f"Falling back to the original {attachment.filename}")
+            self.metrics.inc('proxy_renditions_total', result='fallback')
+        
+        if USE_DISCORD_ATTACHMENT_READ:
+            # Indexed attachments are plain records, read through discord.py's HTTP client the way Attachment.read() does
+            read = getattr(attachment, 'read', None)
+            image_data = await (read() if read is not None else self.bot.http.get_from_cdn(attachment.url))
+            if sniff_image_type(image_data) is None:
+                logger.warning(f"Attachment {attachment.filename} is not an image")
+                self.metrics.inc('errors_total', stage='download', cause='not_image')
+                return None
+            self.metrics.inc('image_bytes_in_total', len(image_data))
+            return image_data
+        return await self.download_image(attachment.url, headers=headers)
     
     @commands.Cog.listener()
     async def on_message(self, message):
+        # Remember posted images so 'image context of' doesn't have to scan history
+        if message.attachments or 'http' in message.content:
+            await self.index_message_images(message)
+            # Describe images in opted-in channels before anyone asks for them
+            if (message.channel.id in self.prefetch_channels and not message.author.bot
+                    and "tell me context of image" not in message.content.lower()):
+                task = asyncio.create_task(self.prefetch_message_images(message))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+        
         # Ignore bot messages
         if message.author.bot:
             return
         
         # Check if the message contains the trigger phrase
         if "tell me context of image" in message.content.lower():
-            await self.handle_image_context_request(message)
+            with self.metrics.stage('image_context_request'):
+                await self.handle_image_context_request(message)
         
         # Check for user-specific image context requests
         elif "image context of" in message.content.lower() and "@" in message.content:
-            await self.handle_user_image_context_request(message)
+            with self.metrics.stage('user_image_context_request'):
+                await self.handle_user_image_context_request(message)
+    
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        # Forget deleted images so they aren't described later
+        if payload.cached_message is not None:
+            self.recent_images.discard(payload.channel_id, payload.cached_message.author.id, payload.message_id)
     
     async def handle_image_context_request(self, message):
         """Handle requests for image context analysis"""
+        # Failures are already explained by DM here, so reactions-only mode doesn't repeat them
+        status = self.start_status(message.channel, message)
         try:
-            # Check if there are any images in the message
-            if not message.attachments:
-                # Check if there are any images in the message content (URLs)
-                image_urls = await self.extract_image_urls(message.content)
-                if not image_urls:
-                    await message.author.send("I couldn't find any images to analyze. Please attach an image or provide an image URL along with your request.")
-                    return
-                
-                # Process the first image URL found
-                image_url = image_urls[0]
-                context = await self.analyze_image_from_url(image_url)
-            else:
-                # Process attached images
-                attachment = message.attachments[0]
-                if not self.is_image_file(attachment.filename):
-                    await message.author.send("Please attach an image file (PNG, JPG, JPEG, GIF, etc.) for me to analyze.")
-                    return
-                
-                context = await self.analyze_image_from_attachment(attachment)
+            # Collect every image in the message, attachments first and then URLs
+            attachments = [a for a in message.attachments if self.is_image_file(a.filename)]
+            image_urls = await self.extract_image_urls(message.content)
+            if not attachments and not image_urls:
+                if message.attachments:
+                    await self.dm_delivery.deliver(message.author, "Please attach an image file (PNG, JPG, JPEG, GIF, etc.) for me to analyze.")
+                else:
+                    await self.dm_delivery.deliver(message.author, "I couldn't find any images to analyze. Please attach an image or provide an image URL along with your request.")
+                return
             
-            if context:
+            # Download all of them at once, up to the per-request limit
+            attachments = attachments[:MAX_IMAGES_PER_REQUEST]
+            image_urls = image_urls[:MAX_IMAGES_PER_REQUEST - len(attachments)]
+            downloads = [self.read_attachment(a) for a in attachments] + [self.download_image(url) for url in image_urls]
+            with self.metrics.stage('download'):
+                results = await asyncio.gather(*downloads, return_exceptions=True)
+            images = []
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Error downloading image: {result}")
+                    self.metrics.inc('errors_total', stage='download', cause=type(result).__name__)
+                elif result is not None:
+                    images.append(result)
+            
+            contexts = []
+            progressive = None
+            if images:
+                await status.update(f"👁️ **{message.author.display_name}**, I'm analyzing the image and will send you the context via direct message!")
+                # Previews are worked out alongside hashing and analysis rather than in front of them
+                previews_task = asyncio.ensure_future(self.preview_images(images))
+                quick_look = None
+                try:
+                    with self.metrics.stage('perceptual_hash'):
+                        phashes = await asyncio.gather(*[self.compute_perceptual_hash(image) for image in images])
+                    # Solid colours and emoji-size images are described locally, only the rest go to the API. Only
+                    # images small enough on disk to be one of those wait for their preview before being analyzed
+                    contexts = [None] * len(images)
+                    if SKIP_TRIVIAL_IMAGES and any(self.check_might_be_trivial(image) for image in images):
+                        previews = await previews_task
+                        for i, preview in enumerate(previews):
+                            if preview is not None and preview.trivial:
+                                contexts[i] = trivial_description(preview)
+                        if any(contexts):
+                            self.metrics.inc('trivial_images_total', sum(1 for context in contexts if context))
+                    # Descriptions we already have don't wait on the API, so they don't get a quick look either
+                    policy = self.routing_policy(message.guild)
+                    for i, (image, phash) in enumerate(zip(images, phashes)):
+                        if contexts[i] is None:
+                            contexts[i] = await self.cached_description(image, phash, policy)
+                    waiting = [i for i, context in enumerate(contexts) if context is None]
+                    if LOCAL_PREVIEW and waiting:
+                        # Basic facts go out as soon as they're known, queued ahead of any of the descriptions
+                        quick_look = asyncio.ensure_future(self.send_quick_look(message.author, previews_task, waiting))
+                    if waiting:
+                        # A single image can be streamed into the DM as it's written, behind the quick look
+                        on_partial = None
+                        if STREAM_RESPONSES and len(images) == 1:
+                            progressive = ProgressiveDM(self.dm_delivery, message.author, "Image Context Analysis",
+                                                        interval=STREAM_EDIT_INTERVAL, after=quick_look)
+                            on_partial = progressive.update
+                        with self.metrics.stage('analysis'):
+                            results = await self.analyze_images(
+                                [images[i] for i in waiting], [phashes[i] for i in waiting], origin=message, on_partial=on_partial
+                            )
+                        for i, context in zip(waiting, results):
+                            contexts[i] = context
+                    # The quick look has to be queued before the descriptions are
+                    if quick_look is not None:
+                        await quick_look
+                    # Nothing needs previews that are still being worked out
+                    previews_task.cancel()
+                except BaseException as e:
+                    # No "description is on its way" after the request has failed
+                    previews_task.cancel()
+                    if quick_look is not None:
+                        quick_look.cancel()
+                    if progressive is not None and isinstance(e, Exception):
+                        await progressive.fail()
+                    raise
+            
+            if any(contexts):
                 # Store the image context in user's history
-                if message.author.id not in self.user_image_history:
-                    self.user_image_history[message.author.id] = []
-                
-                # Store image data (limit to last 10 images per user)
-                image_data = {
-                    'timestamp': message.created_at,
-                    'context': context,
-                    'channel': message.channel.name,
-                    'guild': message.guild.name if message.guild else 'DM'
-                }
-                
-                self.user_image_history[message.author.id].append(image_data)
-                
-                # Keep only last 10 images per user
-                if len(self.user_image_history[message.author.id]) > 10:
-                    self.user_image_history[message.author.id] = self.user_image_history[message.author.id][-10:]
-                
-                # Notify the user in the channel that we'll send them a DM
-                await message.channel.send(f"👁️ **{message.author.display_name}**, I'm analyzing the image and will send you the context via direct message!")
-                
-                # Send the context privately to the user (with character limit)
-                context_preview = context[:1500] + "..." if len(context) > 1500 else context
-                await message.author.send(f"**Image Context Analysis:**\n\n{context_preview}")
+                for context, phash in zip(contexts, phashes):
+                    if not context:
+                        continue
+                    image_data = {
+                        'timestamp': message.created_at,
+                        'context': context,
+                        'channel': message.channel.name,
+                        'guild': message.guild.name if message.guild else 'DM',
+                        'channel_id': message.channel.id,
+                        'guild_id': message.guild.id if message.guild else None,
+                        'phash': phash
+                    }
+                    
+                    await self.image_history.add(message.author.id, image_data)
                 
-                # If context was truncated, send the rest in a follow-up message
-                if len(context) > 1500:
-                    remaining_context = context[1500:]
-                    chunks = [remaining_context[i:i+1500] for i in range(0, len(remaining_context), 1500)]
-                    for i, chunk in enumerate(chunks):
-                        await message.author.send(f"**Continued... (Part {i+2}):**\n\n{chunk}")
+                # Send the context privately to the user, one section per image, queued together
+                with self.metrics.stage('dm_send'):
+                    deliveries = []
+                    for i, context in enumerate(contexts, 1):
+                        if len(contexts) == 1:
+                            title = "Image Context Analysis"
+                        else:
+                            title = f"Image Context Analysis (Image {i} of {len(contexts)})"
+                        if context:
+                            deliveries.append(self.send_context_dm(message.author, title, context, progressive=progressive))
+                        else:
+                            deliveries.append(self.dm_delivery.deliver(message.author, f"**{title}:**\n\nI encountered an error while analyzing this image."))
+                    await asyncio.gather(*deliveries)
                 
-                # Add a reaction to acknowledge the request was processed
-                await message.add_reaction('✅')
+                # Mark the request as done, with a ✅ reaction
+                await status.finish()
             else:
                 # Notify the user in the channel about the error
-                await message.channel.send(f"❌ **{message.author.display_name}**, I encountered an error while analyzing the image. Please try again.")
-                await message.author.send("I encountered an error while analyzing the image. Please try again.")
+                await status.finish(f"❌ **{message.author.display_name}**, I encountered an error while analyzing the image. Please try again.", success=False)
+                if progressive is not None:
+                    await progressive.fail()
+                await self.dm_delivery.deliver(message.author, "I encountered an error while analyzing the image. Please try again.")
                 
+        except QueueFullError:
+            self.metrics.inc('errors_total', stage='analysis', cause='queue_full')
+            await status.finish(f"⏳ **{message.author.display_name}**, I'm handling too many image requests right now. Please try again in a minute.", success=False)
+            await self.dm_delivery.deliver(message.author, "⏳ I'm handling too many image requests right now. Please try again in a minute.")
+        except CircuitOpenError:
+            self.metrics.inc('errors_total', stage='analysis', cause='circuit_open')
+            await status.finish(f"🔌 **{message.author.display_name}**, the image description service is having trouble right now. Please try again in a few minutes.", success=False)
+            await self.dm_delivery.deliver(message.author, "🔌 The image description service is having trouble right now, so I'm not sending it new images for a little while. Please try again in a few minutes.")
         except Exception as e:
             logger.error(f"Error processing image context request: {e}")
-            await message.author.send("I encountered an error while processing your request. Please try again later.")
+            await status.finish(f"❌ **{message.author.display_name}**, I encountered an error while processing your request. Please try again.", success=False)
+            await self.dm_delivery.deliver(message.author, "I encountered an error while processing your request. Please try again later.")
+    
+    def check_might_be_trivial(self, image_data):
+        """Whether an image might be described locally, False if its header can't be read
+
+        Only the header is parsed, so this runs inline.
+        """
+        try:
+            return might_be_trivial(image_data, TRIVIAL_MAX_SIDE)
+        except Exception:
+            return False
+    
+    async def preview_images(self, images):
+        """Compute a quick local preview of each image, None where one can't be made"""
+        async def preview(image_data):
+            try:
+                return await self.run_cpu(build_preview, image_data, TRIVIAL_MAX_SIDE)
+            except Exception as e:
+                logger.warning(f"Could not preview image: {e}")
+                return None
+        
+        with self.metrics.stage('preview'):
+            return await asyncio.gather(*[preview(image) for image in images])
+    
+    async def send_quick_look(self, user, previews_task, waiting):
+        """Queue the quick look DM for the images at the given indexes, which are waiting on the API"""
+        previews = await previews_task
+        if len(previews) == 1:
+            text = format_preview(previews[0]) if previews[0] is not None else None
+        else:
+            text = '\n\n'.join(
+                f"**Image {i + 1}:**\n{format_preview(previews[i])}"
+                for i in waiting if previews[i] is not None
+            )
+        if not text:
+            return
+        
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.warning(f"Could not send preview to {user}: {future.exception()}")
+        
+        sent = self.dm_delivery.send(user, "Quick Look", f"{text}\n\n⏳ The full description is on its way.")
+        sent.add_done_callback(log_failure)
+    
+    def start_status(self, channel, trigger, requester=None):
+        """Create the channel status for a request, DMing failures to the requester in reactions-only mode"""
+        on_error = (lambda text: self.dm_delivery.deliver(requester, text)) if requester is not None else None
+        return StatusMessage(
+            channel, trigger,
+            reactions_only=STATUS_MODE == 'reactions',
+            interval=STATUS_EDIT_INTERVAL,
+            on_error=on_error
+        )
+    
+    async def send_context_dm(self, user, title, context, progressive=None):
+        """DM an image description, split into several messages if it's long"""
+        # A streamed description just needs its final edit
+        if progressive is not None and progressive.started:
+            await progressive.finish(context)
+            return
+        
+        # Packed at natural breaks into as few messages as fit, behind anything else queued for this user
+        await self.dm_delivery.send(user, title, context)
     
     async def handle_user_image_context_request(self, message):
         """Handle requests for image context from a specific user's history"""
+        status = self.start_status(message.channel, message, message.author)
         try:
             # Extract mentioned user
             mentioned_user = None
@@ -137,32 +2701,37 @@ class ImageContextBot(commands.Cog):
                 break
             
             if not mentioned_user:
-                await message.channel.send("❌ Please mention a user to get their image context. Example: 'image context of @username'")
+                await status.finish("❌ Please mention a user to get their image context. Example: 'image context of @username'", success=False)
                 return
             
             # Always search for the most recent image (assume it's new)
-            await message.channel.send(f"🔍 **{message.author.display_name}**, I'm searching for {mentioned_user.display_name}'s most recent image to analyze...")
+            await status.update(f"🔍 **{message.author.display_name}**, I'm searching for {mentioned_user.display_name}'s most recent image to analyze...")
             
             # Search recent messages for images from this user
-            recent_image = await self.find_recent_user_image(message.channel, mentioned_user)
+            with self.metrics.stage('history_lookup'):
+                recent_image = await self.find_recent_user_image(message.channel, mentioned_user)
             
             if recent_image:
                 # Analyze the found image
-                await message.channel.send(f"📸 Found an image! Analyzing {mentioned_user.display_name}'s recent image...")
-                context = await self.analyze_image_with_openai(recent_image['image_data'])
+                await status.update(f"📸 Found an image! Analyzing {mentioned_user.display_name}'s recent image...")
+                with self.metrics.stage('perceptual_hash'):
+                    phash = await self.compute_perceptual_hash(recent_image['image_data'])
+                title = f"Image Context from {mentioned_user.display_name}'s recent image"
+                progressive = ProgressiveDM(self.dm_delivery, message.author, title, interval=STREAM_EDIT_INTERVAL) if STREAM_RESPONSES else None
+                try:
+                    with self.metrics.stage('analysis'):
+                        context = await self.analyze_image_with_openai(
+                            recent_image['image_data'], phash=phash, origin=message,
+                            on_partial=progressive.update if progressive else None
+                        )
+                except Exception:
+                    if progressive is not None:
+                        await progressive.fail()
+                    raise
                 
                 if context:
-                    # Store in history (replacing old context if it exists)
-                    if mentioned_user.id not in self.user_image_history:
-                        self.user_image_history[mentioned_user.id] = []
-                    
-                    # Check if this is the same image (by timestamp proximity - within 1 hour)
-                    is_new_image = True
-                    if self.user_image_history[mentioned_user.id]:
-                        last_image = self.user_image_history[mentioned_user.id][-1]
-                        time_diff = abs((recent_image['timestamp'] - last_image['timestamp']).total_seconds())
-                        if time_diff < 3600:  # Less than 1 hour difference
-                            is_new_image = False
+                    # Check if this is the same image (perceptual hash close to one we've already stored)
+                    is_new_image = not await self.image_history.has_similar(mentioned_user.id, phash, PHASH_MAX_DISTANCE)
                     
                     if is_new_image:
                         # Add new image to history
@@ -170,34 +2739,38 @@ class ImageContextBot(commands.Cog):
                             'timestamp': recent_image['timestamp'],
                             'context': context,
                             'channel': message.channel.name,
-                            'guild': message.guild.name if message.guild else 'DM'
+                            'guild': message.guild.name if message.guild else 'DM',
+                            'channel_id': message.channel.id,
+                            'guild_id': message.guild.id if message.guild else None,
+                            'phash': phash
                         }
                         
-                        self.user_image_history[mentioned_user.id].append(image_data)
-                        await message.channel.send(f"🆕 **New image detected!** I've analyzed {mentioned_user.display_name}'s latest image and will send you the context via direct message!")
+                        await self.image_history.add(mentioned_user.id, image_data)
+                        await status.update(f"🆕 **New image detected!** I've analyzed {mentioned_user.display_name}'s latest image and will send you the context via direct message!")
                     else:
-                        await message.channel.send(f"📸 **Same image detected.** I've re-analyzed {mentioned_user.display_name}'s image and will send you the context via direct message!")
-                    
-                    # Send context to requester (with character limit)
-                    context_preview = context[:1500] + "..." if len(context) > 1500 else context
-                    await message.author.send(f"**Image Context from {mentioned_user.display_name}'s recent image:**\n\n{context_preview}")
+                        await status.update(f"📸 **Same image detected.** I've re-analyzed {mentioned_user.display_name}'s image and will send you the context via direct message!")
                     
-                    # If context was truncated, send the rest in a follow-up message
-                    if len(context) > 1500:
-                        remaining_context = context[1500:]
-                        chunks = [remaining_context[i:i+1500] for i in range(0, len(remaining_context), 1500)]
-                        for i, chunk in enumerate(chunks):
-                            await message.author.send(f"**Continued... (Part {i+2}):**\n\n{chunk}")
+                    # Send context to requester
+                    with self.metrics.stage('dm_send'):
+                        await self.send_context_dm(message.author, title, context, progressive=progressive)
                     
-                    await message.add_reaction('✅')
+                    await status.finish()
                 else:
-                    await message.channel.send(f"❌ **{message.author.display_name}**, I couldn't analyze {mentioned_user.display_name}'s image. Please try again.")
+                    await status.finish(f"❌ **{message.author.display_name}**, I couldn't analyze {mentioned_user.display_name}'s image. Please try again.", success=False)
+                    if progressive is not None:
+                        await progressive.fail()
             else:
-                await message.channel.send(f"❌ **{message.author.display_name}**, I couldn't find any recent images from {mentioned_user.display_name} in this channel.\n\n💡 **Tip**: Make sure they've posted an image recently.")
+                await status.finish(f"❌ **{message.author.display_name}**, I couldn't find any recent images from {mentioned_user.display_name} in this channel.\n\n💡 **Tip**: Make sure they've posted an image recently.", success=False)
             
+        except QueueFullError:
+            self.metrics.inc('errors_total', stage='analysis', cause='queue_full')
+            await status.finish(f"⏳ **{message.author.display_name}**, I'm handling too many image requests right now. Please try again in a minute.", success=False)
+        except CircuitOpenError:
+            self.metrics.inc('errors_total', stage='analysis', cause='circuit_open')
+            await status.finish(f"🔌 **{message.author.display_name}**, the image description service is having trouble right now. Please try again in a few minutes.", success=False)
         except Exception as e:
             logger.error(f"Error processing user image context request: {e}")
-            await message.channel.send(f"❌ **{message.author.display_name}**, I encountered an error while processing your request. Please try again.")
+            await status.finish(f"❌ **{message.author.display_name}**, I encountered an error while processing your request. Please try again.", success=False)
     
     async def extract_image_urls(self, content):
         """Extract image URLs from message content"""
@@ -212,37 +2785,6 @@ class ImageContextBot(commands.Cog):
         image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.tiff'}
         return any(filename.lower().endswith(ext) for ext in image_extensions)
     
-    async def analyze_image_from_attachment(self, attachment):
-        """Analyze an image from a Discord attachment"""
-        try:
-            # Download the image
-            async with aiohttp.ClientSession() as session:
-                async with session.get(attachment.url) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        return await self.analyze_image_with_openai(image_data)
-                    else:
-                        logger.error(f"Failed to download image: {response.status}")
-                        return None
-        except Exception as e:
-            logger.error(f"Error downloading attachment: {e}")
-            return None
-    
-    async def analyze_image_from_url(self, image_url):
-        """Analyze an image from a URL"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        return await self.analyze_image_with_openai(image_data)
-                    else:
-                        logger.error(f"Failed to download image from URL: {response.status}")
-                        return None
-        except Exception as e:
-            logger.error(f"Error downloading image from URL: {e}")
-            return None
-    
     @commands.command(name='status')
     async def status_command(self, ctx):
         """Check bot status and usage instructions"""
@@ -266,27 +2808,80 @@ class ImageContextBot(commands.Cog):
             value="✅ Online and ready to help!",
             inline=False
         )
+        embed.add_field(
+            name="Analysis Queue",
+            value=f"Running: {self.scheduler.active}/{self.scheduler.workers}\nWaiting: {self.scheduler.pending}/{self.scheduler.max_queue}\nBackground: {len(self.scheduler.background)} queued\nWorker processes: {ANALYSIS_WORKER_PROCESSES or 'off'}\nCompleted: {self.scheduler.completed}\nTurned away: {self.scheduler.rejected}\nRate limited: {self.scheduler.rate_limited}\nCoalesced duplicates: {self.inflight.shared}",
+            inline=False
+        )
+        breaker = self.resilience.breaker
+        embed.add_field(
+            name="Vision API",
+            value=f"Health: {'✅ OK' if breaker.state == 'closed' else '🔌 Failing, paused (' + breaker.state + ')'}\nRetries: {self.resilience.retries}\nTimeouts: {self.resilience.timeouts}\nHedged: {self.resilience.hedges} (won {self.resilience.hedge_wins})",
+            inline=False
+        )
+        lag = self.metrics.percentiles('event_loop_lag_seconds')
+        if lag:
+            embed.add_field(
+                name="Event Loop",
+                value=f"Lag: {lag[50] * 1000:.0f}ms (p50), {lag[99] * 1000:.0f}ms (p99), {self.loop_monitor.max_lag * 1000:.0f}ms (max)\nStalls: {self.loop_monitor.stalls}\nCPU work: {CPU_EXECUTOR_WORKERS} {CPU_EXECUTOR} workers",
+                inline=False
+            )
+        first_token = self.metrics.percentiles('first_token_seconds')
+        if first_token:
+            embed.add_field(
+                name="Streaming",
+                value=f"First text after: {first_token[50]:.2f}s (p50), {first_token[95]:.2f}s (p95)",
+                inline=False
+            )
+        cache_stats = self.description_cache.stats()
+        embed.add_field(
+            name="Description Cache",
+            value=f"Entries: {cache_stats['entries']}\nHits: {cache_stats['hits']} (disk: {cache_stats['disk_hits']})\nNear-duplicate hits: {self.perceptual_index.hits}\nMisses: {cache_stats['misses']}\nHit rate: {cache_stats['hit_rate']:.0%}",
+            inline=False
+        )
+        embed.add_field(name="Memory", value=self.memory_report(), inline=False)
         await ctx.send(embed=embed)
     
+    def memory_report(self):
+        """Summarize the process's memory use and the size of each in-memory store"""
+        lines = []
+        rss = current_rss_bytes()
+        if rss is not None:
+            lines.append(f"Process: {rss / (1024 * 1024):.0f} MB")
+        if isinstance(self.image_history, MemoryHistoryStore):
+            history = self.image_history.stats()
+            lines.append(
+                f"History: {history['entries']}/{self.image_history.max_entries} entries for {history['users']} users, "
+                f"{history['bytes'] / (1024 * 1024):.1f}/{self.image_history.max_bytes / (1024 * 1024):.0f} MB "
+                f"({history['evicted']} evicted, {history['expired']} expired)"
+            )
+        else:
+            lines.append(f"History: on disk ({len(self.image_history.pending)} waiting to be written)")
+        lines.append(f"Description cache: {self.description_cache.stats()['entries']}/{self.description_cache.max_entries} entries")
+        lines.append(f"Near-duplicate index: {len(self.perceptual_index.entries)}/{self.perceptual_index.max_entries} images")
+        lines.append(f"Recent image index: {len(self.recent_images.entries)}/{self.recent_images.max_authors} authors")
+        return '\n'.join(lines)
+    
     @commands.command(name='history')
     async def history_command(self, ctx, user: discord.Member = None):
         """View image analysis history for a user (or yourself if no user specified)"""
         target_user = user or ctx.author
         
-        if target_user.id not in self.user_image_history or not self.user_image_history[target_user.id]:
+        total_images = await self.image_history.count(target_user.id)
+        if not total_images:
             await ctx.send(f"❌ No image analysis history found for {target_user.display_name}.")
             return
         
         # Create embed with user's image history
         embed = discord.Embed(
             title=f"📸 Image History for {target_user.display_name}",
-            description=f"Total images analyzed: {len(self.user_image_history[target_user.id])}",
+            description=f"Total images analyzed: {total_images}",
             color=0x0099ff
         )
         
         # Show last 5 images
-        recent_images = self.user_image_history[target_user.id][-5:]
-        for i, img_data in enumerate(reversed(recent_images), 1):
+        recent_images = await self.image_history.recent(target_user.id, limit=5)
+        for i, img_data in enumerate(recent_images, 1):
             timestamp = img_data['timestamp'].strftime("%Y-%m-%d %H:%M")
             channel = img_data['channel']
             embed.add_field(
@@ -300,37 +2895,105 @@ class ImageContextBot(commands.Cog):
     @commands.command(name='refresh')
     async def refresh_command(self, ctx, user: discord.Member = None):
         """Force refresh and search for recent images from a user"""
-        target_user = user or ctx.author
-        
-        await ctx.send(f"🔍 **{ctx.author.display_name}**, I'm doing a fresh search for recent images from {target_user.display_name}...")
+        with self.metrics.stage('refresh_request'):
+            await self.refresh_user_image(ctx, user or ctx.author)
+    
+    async def refresh_user_image(self, ctx, target_user):
+        """Search for and analyze a user's most recent image for !refresh"""
+        status = self.start_status(ctx.channel, ctx.message, ctx.author)
+        await status.update(f"🔍 **{ctx.author.display_name}**, I'm doing a fresh search for recent images from {target_user.display_name}...")
         
         # Force a fresh search
-        recent_image = await self.find_recent_user_image(ctx.channel, target_user, limit=200)
+        with self.metrics.stage('history_lookup'):
+            recent_image = await self.find_recent_user_image(ctx.channel, target_user, limit=200)
         
         if recent_image:
-            await ctx.send(f"📸 Found a recent image! Analyzing {target_user.display_name}'s image...")
-            context = await self.analyze_image_with_openai(recent_image['image_data'])
+            await status.update(f"📸 Found a recent image! Analyzing {target_user.display_name}'s image...")
+            with self.metrics.stage('perceptual_hash'):
+                phash = await self.compute_perceptual_hash(recent_image['image_data'])
+            try:
+                with self.metrics.stage('analysis'):
+                    context = await self.analyze_image_with_openai(recent_image['image_data'], phash=phash, origin=ctx.message)
+            except QueueFullError:
+                self.metrics.inc('errors_total', stage='analysis', cause='queue_full')
+                await status.finish(f"⏳ **{ctx.author.display_name}**, I'm handling too many image requests right now. Please try again in a minute.", success=False)
+                return
+            except CircuitOpenError:
+                self.metrics.inc('errors_total', stage='analysis', cause='circuit_open')
+                await status.finish(f"🔌 **{ctx.author.display_name}**, the image description service is having trouble right now. Please try again in a few minutes.", success=False)
+                return
             
             if context:
                 # Store in history
-                if target_user.id not in self.user_image_history:
-                    self.user_image_history[target_user.id] = []
-                
                 image_data = {
                     'timestamp': recent_image['timestamp'],
                     'context': context,
                     'channel': ctx.channel.name,
-                    'guild': ctx.guild.name if ctx.guild else 'DM'
+                    'guild': ctx.guild.name if ctx.guild else 'DM',
+                    'channel_id': ctx.channel.id,
+                    'guild_id': ctx.guild.id if ctx.guild else None,
+                    'phash': phash
                 }
                 
-                self.user_image_history[target_user.id].append(image_data)
+                await self.image_history.add(target_user.id, image_data)
                 
-                await ctx.send(f"✅ **{ctx.author.display_name}**, I've analyzed {target_user.display_name}'s image and will send you the context via direct message!")
-                await ctx.author.send(f"**Image Context from {target_user.display_name}'s recent image:**\n\n{context}")
+                await status.update(f"✅ **{ctx.author.display_name}**, I've analyzed {target_user.display_name}'s image and will send you the context via direct message!")
+                with self.metrics.stage('dm_send'):
+                    await self.send_context_dm(ctx.author, f"Image Context from {target_user.display_name}'s recent image", context)
+                await status.finish()
             else:
-                await ctx.send(f"❌ **{ctx.author.display_name}**, I couldn't analyze {target_user.display_name}'s image.")
+                await status.finish(f"❌ **{ctx.author.display_name}**, I couldn't analyze {target_user.display_name}'s image.", success=False)
         else:
-            await ctx.send(f"❌ **{ctx.author.display_name}**, I couldn't find any recent images from {target_user.display_name} in the last 200 messages.")
+            await status.finish(f"❌ **{ctx.author.display_name}**, I couldn't find any recent images from {target_user.display_name} in the last 200 messages.", success=False)
+    
+    @commands.command(name='stats')
+    @commands.has_permissions(administrator=True)
+    async def stats_command(self, ctx):
+        """Show per-stage latency percentiles (Admin only)"""
+        embed = discord.Embed(
+            title="📊 BlindBot Performance",
+            description="Latency per stage (p50 / p95 / p99)",
+            color=0x0099ff
+        )
+        
+        summary = self.metrics.stage_summary()
+        if not summary:
+            embed.add_field(name="No data yet", value="No requests have been timed since the bot started.", inline=False)
+        for stage, count, points in summary[:21]:
+            embed.add_field(
+                name=stage,
+                value=f"{points[50] * 1000:.0f} / {points[95] * 1000:.0f} / {points[99] * 1000:.0f} ms\n{count} calls",
+                inline=True
+            )
+        
+        errors = sorted(
+            (labels, value) for (name, labels), value in self.metrics.counters.items() if name == 'errors_total'
+        )
+        if errors:
+            embed.add_field(
+                name="Errors",
+                value="\n".join(f"{dict(labels)['stage']} ({dict(labels)['cause']}): {value}" for labels, value in errors)[:1024],
+                inline=False
+            )
+        
+        routes = sorted(labels for name, labels in self.metrics.histograms if name == 'route_seconds')
+        if routes:
+            lines = []
+            for labels in routes:
+                points = self.metrics.percentiles('route_seconds', **dict(labels))
+                if points:
+                    lines.append(f"{dict(labels)['route']} ({dict(labels)['model']}): {points[50]:.2f}s p50, {points[95]:.2f}s p95")
+            embed.add_field(name="Routes", value="\n".join(lines)[:1024] or "No data yet", inline=False)
+        
+        bytes_in = self.metrics.counters.get(('image_bytes_in_total', ()), 0)
+        bytes_out = self.metrics.counters.get(('image_bytes_out_total', ()), 0)
+        embed.add_field(
+            name="Image Bytes",
+            value=f"Downloaded: {bytes_in / 1_000_000:.1f} MB\nUploaded: {bytes_out / 1_000_000:.1f} MB",
+            inline=False
+        )
+        
+        await ctx.send(embed=embed)
     
     @commands.command(name='guide')
     async def guide_command(self, ctx):
@@ -373,6 +3036,38 @@ class ImageContextBot(commands.Cog):
         
         await ctx.send(embed=embed)
     
+    @commands.command(name='prefetch')
+    @commands.has_permissions(administrator=True)
+    async def prefetch_command(self, ctx, mode: str = None):
+        """Turn background pre-analysis of new images on or off for this channel (Admin only)"""
+        mode = (mode or '').lower()
+        if mode == 'on':
+            self.prefetch_channels.add(ctx.channel.id)
+            logger.info(f"Prefetch enabled for channel {ctx.channel.id} by {ctx.author}")
+            await ctx.send(f"⚡ New images in #{ctx.channel.name} will be described in the background, so requests for them are answered instantly. Add this channel to `PREFETCH_CHANNEL_IDS` to keep it on after a restart.")
+        elif mode == 'off':
+            self.prefetch_channels.discard(ctx.channel.id)
+            logger.info(f"Prefetch disabled for channel {ctx.channel.id} by {ctx.author}")
+            await ctx.send(f"⏸️ Background pre-analysis is off for #{ctx.channel.name}.")
+        else:
+            state = "on" if ctx.channel.id in self.prefetch_channels else "off"
+            await ctx.send(f"Background pre-analysis is **{state}** for #{ctx.channel.name} ({PREFETCH_PER_HOUR} analyses per hour across all channels). Use `!prefetch on` or `!prefetch off`.")
+    
+    @commands.command(name='routing')
+    @commands.has_permissions(administrator=True)
+    async def routing_command(self, ctx, policy: str = None):
+        """Show or set how this server's images are routed between models (Admin only)"""
+        if ctx.guild is None:
+            await ctx.send("❌ Routing policies are set per server.")
+            return
+        policy = (policy or '').lower()
+        if policy in ROUTING_POLICIES:
+            self.guild_policies[ctx.guild.id] = policy
+            logger.info(f"Routing policy for guild {ctx.guild.id} set to {policy} by {ctx.author}")
+            await ctx.send(f"🧭 Images in this server now use the **{policy}** routing policy. Add `{ctx.guild.id}:{policy}` to `ROUTING_GUILD_POLICIES` to keep it after a restart.")
+        else:
+            await ctx.send(f"🧭 This server uses the **{self.routing_policy(ctx.guild)}** routing policy. Choose one of: {', '.join(ROUTING_POLICIES)}.\n• **quality**: always the full model at automatic detail\n• **balanced**: simple images go to the fast model, photos at low detail, screenshots at high detail\n• **economy**: like balanced, but photos also go to the fast model")
+    
     @commands.command(name='shutdown')
     @commands.has_permissions(administrator=True)
     async def shutdown_command(self, ctx):
@@ -382,109 +3077,605 @@ class ImageContextBot(commands.Cog):
         # Close the bot gracefully
         await bot.close()
     
-    async def analyze_image_with_openai(self, image_data):
+    async def run_cpu(self, func, *args, size=None):
+        """Run CPU-bound work in the CPU executor, or inline when its input is smaller than size says is worth moving"""
+        if size is not None and size < CPU_OFFLOAD_MIN_BYTES:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_executor, func, *args)
+    
+    async def compute_perceptual_hash(self, image_data):
+        """Compute an image's perceptual hash off the event loop, or None if it can't be decoded"""
+        try:
+            return await self.run_cpu(compute_dhash, image_data)
+        except Exception as e:
+            logger.warning(f"Could not compute perceptual hash: {e}")
+            return None
+    
+    async def prepare_upload(self, image_data):
+        """Preprocess an image off the event loop, returning (bytes, MIME type, animation info) for upload"""
+        if PREPROCESS_MAX_SIDE > 0:
+            try:
+                return await self.run_cpu(
+                    preprocess_image, image_data, PREPROCESS_MAX_SIDE, PREPROCESS_FORMAT, PREPROCESS_QUALITY,
+                    ANIMATION_MAX_FRAMES, ANIMATION_DECODE_SECONDS
+                )
+            except Exception as e:
+                logger.warning(f"Could not preprocess image, uploading original: {e}")
+        return image_data, sniff_image_type(image_data) or 'image/jpeg', None
+    
+    def routing_policy(self, guild):
+        """The routing policy for a guild, falling back to the default"""
+        return self.guild_policies.get(guild.id if guild is not None else None, ROUTING_POLICY)
+    
+    @staticmethod
+    def description_key(image_data, policy):
+        """Cache key for an image's description, which depends on the routing policy that produced it"""
+        return DescriptionCache.make_key(image_data, VISION_PROMPT, f"{VISION_MODEL}/{policy}")
+    
+    async def compute_description_key(self, image_data, policy):
+        """Hash an image for its description key, off the event loop when it's large"""
+        return await self.run_cpu(self.description_key, image_data, policy, size=len(image_data))
+    
+    async def route_image(self, image_data, policy):
+        """Choose a route for an image from its features, measured off the event loop"""
+        features = None
+        if policy != 'quality':
+            try:
+                features = await self.run_cpu(extract_image_features, image_data)
+            except Exception as e:
+                logger.warning(f"Could not measure image features, using the default route: {e}")
+        route = choose_route(features, policy)
+        self.metrics.inc('routes_total', route=route.name, model=route.model)
+        return route
+    
+    def charge_extra_call(self):
+        """Count a retry or hedge against the API rate limits like any other call"""
+        self.scheduler.request_bucket.consume(1)
+        self.scheduler.token_bucket.consume(self.scheduler.tokens_per_job)
+    
+    async def run_scheduled(self, origin, job_factory, background_key=None):
+        """Run an API job through the scheduler, letting the requester know if they have to wait"""
+        guild_id = origin.guild.id if origin is not None and origin.guild else None
+        user_id = origin.author.id if origin is not None else None
+        submitted = time.monotonic()
+        
+        async def timed_job():
+            self.metrics.observe(
+                'queue_wait_seconds', time.monotonic() - submitted,
+                priority='background' if background_key is not None else 'interactive'
+            )
+            with self.metrics.stage('openai_call'):
+                return await job_factory()
+        
+        if background_key is not None:
+            future = self.scheduler.submit_background(background_key, timed_job)
+            if future is None:
+                raise QueueFullError("Background analysis queue is full")
+            return await future
+        
+        future, position = self.scheduler.submit(guild_id, user_id, timed_job)
+        if origin is not None and position > self.scheduler.workers - self.scheduler.active:
+            eta = math.ceil(self.scheduler.estimate_wait(position))
+            try:
+                await self.dm_delivery.deliver(origin.author, f"⏳ I'm handling a lot of requests right now. You're #{position} in the queue, your description should arrive in about {eta} seconds.")
+            except discord.HTTPException as e:
+                logger.warning(f"Could not send queue position to {origin.author}: {e}")
+        return await future
+    
+    async def analyze_image_with_openai(self, image_data, phash=None, origin=None, on_partial=None):
         """Analyze image using OpenAI's vision API"""
         try:
-            # Convert image data to base64
-            import base64
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+            # Reuse a previous description of the exact same image if we have one
+            policy = self.routing_policy(origin.guild if origin is not None else None)
+            cache_key = await self.compute_description_key(image_data, policy)
+            cached = await self.description_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Description cache hit for image {cache_key[:12]}")
+                return cached
             
-            # Create the message for OpenAI
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Provide a concise but detailed description of this image for a blind person. Include:\n- Main objects, people, scenes\n- Layout and positioning\n- Key colors and textures\n- Any readable text\n- Overall mood\n- Notable elements\n\nKeep it under 1500 characters while being descriptive and helpful."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ]
+            # Fail fast instead of queueing behind an upstream that is down
+            self.resilience.breaker.check()
             
-            # Call OpenAI API
-            response = await self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.7
-            )
+            # Someone is waiting now, so a queued background analysis of this image can't stay low priority
+            if origin is not None:
+                guild_id = origin.guild.id if origin.guild else None
+                if self.scheduler.promote(('analysis', cache_key), guild_id, origin.author.id):
+                    logger.info(f"Promoted background analysis of image {cache_key[:12]}")
             
-            return response.choices[0].message.content
+            # Concurrent requests for the same image wait on a single analysis
+            return await self.inflight.run(
+                ('analysis', cache_key),
+                lambda: self.describe_image(image_data, cache_key, phash, origin, on_partial, policy=policy)
+            )
             
+        except (QueueFullError, CircuitOpenError):
+            raise
         except Exception as e:
             logger.error(f"Error calling OpenAI API: {e}")
+            self.metrics.inc('errors_total', stage='analysis', cause=type(e).__name__)
             return None
     
-    async def find_recent_user_image(self, channel, user, limit=100):
-        """Find the most recent image posted by a specific user in a channel"""
+    async def cached_description(self, image_data, phash, policy):
+        """A description we already have for an image or a near-duplicate of it, None if it has to go to the API"""
+        cached = await self.description_cache.get(await self.compute_description_key(image_data, policy))
+        if cached is None and phash is not None:
+            cached = self.perceptual_index.find(phash, (VISION_MODEL, VISION_PROMPT, policy), PHASH_MAX_DISTANCE)
+        return cached
+    
+    async def analyze_images(self, images, phashes, origin=None, on_partial=None):
+        """Analyze several images concurrently, packing them into shared API calls when batching is on"""
+        if len(images) == 1:
+            return [await self.analyze_image_with_openai(images[0], phash=phashes[0], origin=origin, on_partial=on_partial)]
+        if MULTI_IMAGE_BATCH_SIZE < 2:
+            return await asyncio.gather(*[
+                self.analyze_image_with_openai(image, phash=phash, origin=origin)
+                for image, phash in zip(images, phashes)
+            ])
+        
+        # Answer what we can from the caches, only the rest goes to the API
+        contexts = [None] * len(images)
+        policy = self.routing_policy(origin.guild if origin is not None else None)
+        uncached = []
+        for i, (image, phash) in enumerate(zip(images, phashes)):
+            cached = await self.cached_description(image, phash, policy)
+            if cached is not None:
+                contexts[i] = cached
+            else:
+                uncached.append(i)
+        
+        batches = [uncached[i:i + MULTI_IMAGE_BATCH_SIZE] for i in range(0, len(uncached), MULTI_IMAGE_BATCH_SIZE)]
+        results = await asyncio.gather(*[
+            self.analyze_image_batch([images[i] for i in batch], [phashes[i] for i in batch], origin=origin)
+            for batch in batches
+        ])
+        for batch, descriptions in zip(batches, results):
+            for i, description in zip(batch, descriptions):
+                contexts[i] = description
+        return contexts
+    
+    async def analyze_image_batch(self, images, phashes, origin=None):
+        """Describe several images with a single API call, returning one description per image"""
+        if len(images) == 1:
+            return [await self.analyze_image_with_openai(images[0], phash=phashes[0], origin=origin)]
+        policy = self.routing_policy(origin.guild if origin is not None else None)
         try:
-            # Search through recent messages in the channel with cache bypass
-            async for message in channel.history(limit=limit, before=None):
-                # Skip if message is from a different user
-                if message.author.id != user.id:
+            with self.metrics.stage('preprocess'):
+                uploads = await asyncio.gather(*[self.prepare_upload(image) for image in images])
+            self.metrics.inc('image_bytes_out_total', sum(len(upload[0]) for upload in uploads))
+            with self.metrics.stage('routing'):
+                routes = await asyncio.gather(*[self.route_image(image, policy) for image in images])
+            # One call has one model and budget, so the batch takes the strongest model any image needs
+            model = VISION_MODEL if any(route.model == VISION_MODEL for route in routes) else routes[0].model
+            max_tokens = sum(route.max_tokens for route in routes)
+            
+            with self.metrics.stage('encode'):
+                image_urls = await asyncio.gather(*[
+                    self.run_cpu(to_data_url, upload_data, mime_type, size=len(upload_data))
+                    for upload_data, mime_type, frames in uploads
+                ])
+            content = [{"type": "text", "text": BATCH_PROMPT.format(count=len(images))}]
+            for i, ((upload_data, mime_type, frames), route, image_url) in enumerate(zip(uploads, routes, image_urls), 1):
+                if frames is not None:
+                    content.append({"type": "text", "text": f"Image {i}: {animation_note(frames)}"})
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                        "detail": 'high' if frames is not None else route.detail
+                    }
+                })
+            
+            logger.info(f"Routing batch of {len(images)} images to {model} with {max_tokens} tokens under the '{policy}' policy")
+            text, usage = await self.run_scheduled(origin, lambda: self.resilience.call(lambda: self.request_completion(
+                [{"role": "user", "content": content}],
+                max_tokens=max_tokens,
+                model=model
+            )))
+            if usage is not None:
+                self.scheduler.record_usage(usage.total_tokens)
+            
+            descriptions = split_batch_response(text or '', len(images))
+        except (QueueFullError, CircuitOpenError):
+            raise
+        except Exception as e:
+            logger.error(f"Error calling OpenAI API for {len(images)} images: {e}")
+            return [None] * len(images)
+        
+        if descriptions is None:
+            # The model didn't give one section per image, so describe them one at a time instead
+            logger.warning(f"Could not split batched response into {len(images)} descriptions, retrying individually")
+            return await asyncio.gather(*[
+                self.analyze_image_with_openai(image, phash=phash, origin=origin)
+                for image, phash in zip(images, phashes)
+            ])
+        
+        # Cache each section on its own so later single-image requests hit it
+        variant = (VISION_MODEL, VISION_PROMPT, policy)
+        for image, phash, description in zip(images, phashes, descriptions):
+            await self.description_cache.set(await self.compute_description_key(image, policy), description)
+            if phash is not None:
+                self.perceptual_index.add(phash, variant, description)
+        return descriptions
+    
+    async def request_completion(self, messages, max_tokens=500, model=VISION_MODEL):
+        """Run a chat completion, returning (text, usage)"""
+        response = await self.openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7
+        )
+        return response.choices[0].message.content, getattr(response, 'usage', None)
+    
+    async def upload_completion(self, messages, image_data, mime_type, max_tokens=500, model=VISION_MODEL):
+        """Run a chat completion whose image is base64-encoded while the request body is sent; returns (text, usage)
+
+        messages carry STREAM_UPLOAD_PLACEHOLDER as the image URL. The data URL is written in its place on the
+        wire, so the encoded image, the data URL string and the JSON body never exist in memory as whole copies.
+        """
+        body = json.dumps({"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": 0.7})
+        head, _, tail = body.partition(STREAM_UPLOAD_PLACEHOLDER)
+        head = f"{head}data:{mime_type};base64,".encode('utf-8')
+        tail = tail.encode('utf-8')
+        length = len(head) + 4 * math.ceil(len(image_data) / 3) + len(tail)
+        
+        async def chunks():
+            yield head
+            view = memoryview(image_data)
+            for start in range(0, len(view), STREAM_UPLOAD_CHUNK_BYTES):
+                yield base64.b64encode(view[start:start + STREAM_UPLOAD_CHUNK_BYTES])
+            yield tail
+        
+        session = await self.get_api_session()
+        # The same headers the SDK sends: its User-Agent, organization, project and any configured defaults
+        headers = {
+            name: value
+            for name, value in {**self.openai_client.default_headers, **self.openai_client.auth_headers}.items()
+            if isinstance(value, str)
+        }
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(length)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=DOWNLOAD_CONNECT_TIMEOUT, sock_read=OPENAI_ATTEMPT_TIMEOUT)
+        url = f"{str(self.openai_client.base_url).rstrip('/')}/chat/completions"
+        try:
+            async with session.post(url, data=chunks(), headers=headers, timeout=timeout) as response:
+                if response.status != 200:
+                    message = f"Error code: {response.status} - {await response.text()}"
+                    try:
+                        retry_after = float(response.headers['retry-after'])
+                    except (KeyError, ValueError):
+                        retry_after = None
+                    if response.status == 429:
+                        raise UpstreamRateLimitError(message, retry_after)
+                    if response.status >= 500 or response.status in (408, 409):
+                        raise UpstreamRetryableError(message, retry_after)
+                    raise UpstreamAPIError(message)
+                data = await response.json()
+        except aiohttp.ClientError as e:
+            raise UpstreamRetryableError(f"Connection error: {e}")
+        usage = data.get('usage')
+        return data['choices'][0]['message']['content'], SimpleNamespace(**usage) if usage else None
+    
+    async def stream_completion(self, messages, on_partial, max_tokens=500, model=VISION_MODEL):
+        """Run a streamed chat completion, passing the text so far to on_partial; returns (text, usage)
+
+        Each call first passes on_partial an empty text, so a retry replaces the partial text of the attempt before it.
+        """
+        await on_partial('')
+        started = time.monotonic()
+        stream = await self.openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        parts = []
+        usage = None
+        async for chunk in stream:
+            # The last chunk carries token usage and no choices
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not parts:
+                latency = time.monotonic() - started
+                self.metrics.observe('first_token_seconds', latency)
+                logger.info(f"First streamed token after {latency:.2f}s")
+            parts.append(chunk.choices[0].delta.content)
+            await on_partial(''.join(parts))
+        return ''.join(parts), usage
+    
+    async def describe_image(self, image_data, cache_key, phash=None, origin=None, on_partial=None, background=False,
+                             policy=ROUTING_POLICY):
+        """Describe an image that isn't cached, reusing a near-duplicate's description if possible"""
+        # Look for a near-duplicate (re-upload, recompression, resize)
+        variant = (VISION_MODEL, VISION_PROMPT, policy)
+        if phash is None:
+            phash = await self.compute_perceptual_hash(image_data)
+        if phash is not None:
+            similar = self.perceptual_index.find(phash, variant, PHASH_MAX_DISTANCE)
+            if similar is not None:
+                logger.info(f"Perceptual hash match for image {cache_key[:12]}")
+                await self.description_cache.set(cache_key, similar)
+                return similar
+        
+        if self.analysis_pool is not None:
+            description = await self.describe_in_worker(image_data, cache_key, origin, background, policy)
+            await self.remember_description(cache_key, phash, variant, description)
+            return description
+        
+        # Shrink the image to what the model actually uses before uploading it
+        with self.metrics.stage('preprocess'):
+            upload_data, mime_type, frames = await self.prepare_upload(image_data)
+        logger.info(f"Prepared image {cache_key[:12]} for upload: {len(image_data)} -> {len(upload_data)} bytes ({mime_type})")
+        prompt = VISION_PROMPT
+        if frames is not None:
+            logger.info(f"Image {cache_key[:12]} is an animation, sending {frames['shown']} of {frames['total']} frames as a contact sheet")
+            prompt = f"{VISION_PROMPT}\n\n{animation_note(frames)}"
+        self.metrics.inc('image_bytes_out_total', len(upload_data))
+        
+        # Pick the model, detail and token budget this image needs
+        with self.metrics.stage('routing'):
+            route = await self.route_image(image_data, policy)
+        if frames is not None:
+            # Contact sheet tiles are small, low detail would blur them away
+            route = route._replace(detail='high')
+        logger.info(f"Routing image {cache_key[:12]} as '{route.name}' under the '{policy}' policy: {route.model}, {route.detail} detail, {route.max_tokens} tokens")
+        
+        # Convert image data to a base64 data URL. Large uploads get a placeholder instead and are
+        # encoded piece by piece as the request is sent (streamed replies go through the SDK as usual)
+        streamed = on_partial is not None and STREAM_RESPONSES
+        stream_upload = not streamed and 0 < STREAM_UPLOAD_MIN_BYTES <= len(upload_data)
+        if stream_upload:
+            image_url = STREAM_UPLOAD_PLACEHOLDER
+        else:
+            with self.metrics.stage('encode'):
+                image_url = await self.run_cpu(to_data_url, upload_data, mime_type, size=len(upload_data))
+        
+        # Create the message for OpenAI
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                            "detail": route.detail
+                        }
+                    }
+                ]
+            }
+        ]
+        
+        # Call OpenAI API, queued behind the scheduler's worker pool and rate limits
+        timing = {}
+        
+        async def job():
+            started = time.monotonic()
+            try:
+                if streamed:
+                    # Two streams can't share one DM, so streamed calls are never hedged
+                    return await self.resilience.call(
+                        lambda: self.stream_completion(messages, on_partial, max_tokens=route.max_tokens, model=route.model),
+                        hedge=False
+                    )
+                if stream_upload:
+                    return await self.resilience.call(lambda: self.upload_completion(
+                        messages, upload_data, mime_type, max_tokens=route.max_tokens, model=route.model
+                    ))
+                return await self.resilience.call(
+                    lambda: self.request_completion(messages, max_tokens=route.max_tokens, model=route.model)
+                )
+            finally:
+                timing['seconds'] = time.monotonic() - started
+                self.metrics.observe('route_seconds', timing['seconds'], route=route.name, model=route.model)
+        
+        description, usage = await self.run_scheduled(
+            origin, job, background_key=('analysis', cache_key) if background else None
+        )
+        if usage is not None:
+            self.scheduler.record_usage(usage.total_tokens)
+        logger.info(f"Route '{route.name}' ({route.model}) described image {cache_key[:12]} in {timing.get('seconds', 0):.2f}s")
+        
+        await self.remember_description(cache_key, phash, variant, description)
+        return description
+    
+    async def describe_in_worker(self, image_data, cache_key, origin=None, background=False, policy=ROUTING_POLICY):
+        """Preprocess, route, encode and describe an image in an analysis worker process"""
+        loop = asyncio.get_running_loop()
+        used = {}
+        
+        def attempt():
+            used['generation'] = self.analysis_pool_generation
+            return loop.run_in_executor(
+                self.analysis_pool, analyze_in_worker, image_data, policy, PREPROCESS_MAX_SIDE, PREPROCESS_FORMAT,
+                PREPROCESS_QUALITY, ANIMATION_MAX_FRAMES, ANIMATION_DECODE_SECONDS
+            )
+        
+        # A call already running in another process can't be cancelled: a hedge would only add load, and an
+        # attempt that timed out keeps its process busy until the worker's own API timeout ends it. Retrying
+        # timeouts would stack another attempt behind it each time, so only errors the worker reported are retried.
+        try:
+            result = await self.run_scheduled(
+                origin, lambda: self.resilience.call(attempt, hedge=False, retry_timeouts=False),
+                background_key=('analysis', cache_key) if background else None
+            )
+        except BrokenProcessPool:
+            # A worker died (out of memory, a crashing decoder). Replace the pool in the background, once, and fail
+            # this request now rather than after the new workers have started
+            task = asyncio.create_task(self.restart_analysis_pool(used.get('generation')))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+            raise
+        
+        for stage, seconds in result['timings'].items():
+            self.metrics.observe('stage_seconds', seconds, stage=stage)
+        route = result['route']
+        self.metrics.inc('routes_total', route=route.name, model=route.model)
+        self.metrics.observe('route_seconds', result['api_seconds'], route=route.name, model=route.model)
+        self.metrics.inc('image_bytes_out_total', result['upload_bytes'])
+        if result['total_tokens'] is not None:
+            self.scheduler.record_usage(result['total_tokens'])
+        if result['frames'] is not None:
+            logger.info(f"Image {cache_key[:12]} is an animation, sent {result['frames']['shown']} of {result['frames']['total']} frames as a contact sheet")
+        logger.info(f"Worker process described image {cache_key[:12]} via route '{route.name}' ({route.model}) in {result['api_seconds']:.2f}s")
+        return result['description']
+    
+    async def remember_description(self, cache_key, phash, variant, description):
+        """Cache a new description by exact key and perceptual hash"""
+        if description:
+            await self.description_cache.set(cache_key, description)
+            if phash is not None:
+                self.perceptual_index.add(phash, variant, description)
+    
+    async def prefetch_message_images(self, message):
+        """Analyze a new message's images at low priority so a later request is answered from the cache"""
+        if PREFETCH_PER_HOUR <= 0:
+            return
+        attachments = [a for a in message.attachments if self.is_image_file(a.filename)]
+        image_urls = await self.extract_image_urls(message.content)
+        sources = [(self.read_attachment, a) for a in attachments] + [(self.download_image, url) for url in image_urls]
+        
+        for fetch, source in sources[:MAX_IMAGES_PER_REQUEST]:
+            if self.prefetch_budget.delay_for(1) > 0:
+                logger.info(f"Prefetch budget used up, skipping images in message {message.id}")
+                self.metrics.inc('prefetch_total', result='over_budget')
+                return
+            try:
+                image_data = await fetch(source)
+                if image_data is None:
+                    continue
+                policy = self.routing_policy(message.guild)
+                cache_key = await self.compute_description_key(image_data, policy)
+                if await self.description_cache.get(cache_key) is not None:
+                    self.metrics.inc('prefetch_total', result='cached')
                     continue
                 
-                # Check for attached images
-                if message.attachments:
-                    for attachment in message.attachments:
-                        if self.is_image_file(attachment.filename):
-                            # Download the image with cache-busting headers
-                            async with aiohttp.ClientSession() as session:
-                                headers = {
-                                    'Cache-Control': 'no-cache',
-                                    'Pragma': 'no-cache',
-                                    'User-Agent': 'BlindBot/1.0'
-                                }
-                                async with session.get(attachment.url, headers=headers) as response:
-                                    if response.status == 200:
-                                        image_data = await response.read()
-                                        logger.info(f"Found attached image from {user.display_name} in message {message.id}")
-                                        return {
-                                            'image_data': image_data,
-                                            'timestamp': message.created_at,
-                                            'message': message
-                                        }
-                
-                # Check for image URLs in message content
-                image_urls = await self.extract_image_urls(message.content)
-                if image_urls:
-                    image_url = image_urls[0]
-                    # Add cache-busting parameter to URL
-                    cache_bust_url = f"{image_url}?cb={int(time.time())}"
-                    async with aiohttp.ClientSession() as session:
-                        headers = {
-                            'Cache-Control': 'no-cache',
-                            'Pragma': 'no-cache',
-                            'User-Agent': 'BlindBot/1.0'
-                        }
-                        async with session.get(cache_bust_url, headers=headers) as response:
-                            if response.status == 200:
-                                image_data = await response.read()
-                                logger.info(f"Found image URL from {user.display_name} in message {message.id}")
-                                return {
-                                    'image_data': image_data,
-                                    'timestamp': message.created_at,
-                                    'message': message
-                                }
+                self.prefetch_budget.consume(1)
+                with self.metrics.stage('prefetch'):
+                    description = await self.inflight.run(
+                        ('analysis', cache_key),
+                        lambda: self.describe_image(image_data, cache_key, background=True, policy=policy)
+                    )
+                self.metrics.inc('prefetch_total', result='analyzed' if description else 'failed')
+            except QueueFullError:
+                self.metrics.inc('prefetch_total', result='queue_full')
+                return
+            except CircuitOpenError:
+                self.metrics.inc('prefetch_total', result='circuit_open')
+                return
+            except Exception as e:
+                logger.warning(f"Background analysis of message {message.id} failed: {e}")
+                self.metrics.inc('errors_total', stage='prefetch', cause=type(e).__name__)
+    
+    async def find_recent_user_image(self, channel, user, limit=100):
+        """Find a user's most recent image, sharing the search with concurrent requests for it"""
+        return await self.inflight.run(
+            ('recent', channel.id, user.id, limit),
+            lambda: self._find_recent_user_image(channel, user, limit)
+        )
+    
+    async def _find_recent_user_image(self, channel, user, limit=100):
+        """Find the most recent image posted by a specific user in a channel"""
+        try:
+            # The index is kept current from on_message, history is only scanned the first time
+            if self.recent_images.backfilled_depth(channel.id) < limit:
+                await self.inflight.run(
+                    ('backfill', channel.id, limit),
+                    lambda: self.backfill_recent_images(channel, limit)
+                )
+            
+            for ref in self.recent_images.lookup(channel.id, user.id):
+                image_data = await self.download_image_ref(channel, ref)
+                if image_data is not None:
+                    logger.info(f"Found image from {user.display_name} in message {ref.message_id}")
+                    return {
+                        'image_data': image_data,
+                        'timestamp': ref.timestamp,
+                        'message_id': ref.message_id
+                    }
             
-            logger.info(f"No images found for {user.display_name} in last {limit} messages")
+            logger.info(f"No images found for {user.display_name} in the recent image index")
             return None
             
         except Exception as e:
             logger.error(f"Error searching for recent user image: {e}")
             return None
+    
+    async def backfill_recent_images(self, channel, limit):
+        """Index the images in a channel's recent history"""
+        async for message in channel.history(limit=limit):
+            await self.index_message_images(message)
+        self.recent_images.mark_backfilled(channel.id, limit)
+        logger.info(f"Backfilled recent image index for channel {channel.id} from {limit} messages")
+    
+    async def index_message_images(self, message):
+        """Remember the first image in a message for 'image context of' lookups"""
+        for attachment in message.attachments:
+            if self.is_image_file(attachment.filename):
+                self.recent_images.add(
+                    message.channel.id, message.author.id,
+                    ImageRef(
+                        message.id, attachment.url, message.created_at,
+                        AttachmentRef(
+                            attachment.id, attachment.filename, attachment.url, attachment.size,
+                            attachment.proxy_url, attachment.width, attachment.height, attachment.content_type
+                        )
+                    )
+                )
+                return
+        if 'http' in message.content:
+            image_urls = await self.extract_image_urls(message.content)
+            if image_urls:
+                self.recent_images.add(
+                    message.channel.id, message.author.id,
+                    ImageRef(message.id, image_urls[0], message.created_at, None)
+                )
+    
+    async def download_image_ref(self, channel, ref):
+        """Download an indexed image, refreshing expired attachment links if needed"""
+        cache_bust_headers = {
+            'Cache-Control': 'no-cache',
+            'Pragma': 'no-cache'
+        }
+        if ref.attachment is None:
+            # Add cache-busting parameter to URL
+            return await self.download_image(f"{ref.url}?cb={int(time.time())}", headers=cache_bust_headers)
+        
+        # Same size limit and read path as attachments in the request itself
+        try:
+            image_data = await self.read_attachment(ref.attachment, headers=cache_bust_headers)
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.info(f"Could not read indexed attachment {ref.attachment.filename}: {e}")
+            image_data = None
+        if image_data is not None or ref.attachment.size > DOWNLOAD_MAX_BYTES:
+            return image_data
+        
+        # Attachment links expire, so fetch the message again for a fresh one
+        try:
+            message = await channel.fetch_message(ref.message_id)
+        except discord.HTTPException as e:
+            logger.info(f"Could not refetch message {ref.message_id}: {e}")
+            return None
+        for attachment in message.attachments:
+            if self.is_image_file(attachment.filename):
+                return await self.read_attachment(attachment, headers=cache_bust_headers)
+        return None
 
 @bot.event
 async def on_ready():
     logger.info(f'{bot.user} has connected to Discord!')
     logger.info(f'Bot is in {len(bot.guilds)} guilds')
+    if BOT_AUTO_SHARD:
+        logger.info(f'Running {bot.shard_count} shards')
     
     # Set bot status
     await bot.change_presence(activity=discord.Activity(
@@ -512,6 +3703,12 @@ async def setup():
 
 # Run the bot
 async def main():
+    # An unknown policy would quietly route like 'balanced', so refuse to start instead
+    routing_errors = routing_config_errors()
+    if routing_errors:
+        for error in routing_errors:
+            logger.error(error)
+        return
     await setup()
     token = os.getenv('DISCORD_TOKEN')
     if not token:
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Unit tests for BlindBot's self-contained helpers
+These run without Discord or OpenAI: python -m pytest test_helpers.py (or python test_helpers.py)
+"""
+
+import asyncio
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from PIL import Image, ImageDraw, ImageFont
+
+import bot
+
+
+def encode_image(img, image_format='PNG'):
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def history_entry(context, phash=None):
+    return {
+        'timestamp': datetime.now(timezone.utc),
+        'context': context,
+        'channel': 'general',
+        'guild': 'Test Guild',
+        'channel_id': 1,
+        'guild_id': 2,
+        'phash': phash
+    }
+
+
+class DescriptionCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def test_hit_and_expiry(self):
+        cache = bot.DescriptionCache(max_entries=8, ttl=60)
+        await cache.set('key', 'a description')
+        self.assertEqual(await cache.get('key'), 'a description')
+        # Age the entry past its TTL
+        cache.entries['key'] = (time.time() - 61, 'a description')
+        self.assertIsNone(await cache.get('key'))
+        self.assertNotIn('key', cache.entries)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    async def test_least_recently_used_entry_is_dropped(self):
+        cache = bot.DescriptionCache(max_entries=2, ttl=60)
+        await cache.set('a', 'A')
+        await cache.set('b', 'B')
+        await cache.get('a')
+        await cache.set('c', 'C')
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_key_depends_on_prompt_and_model(self):
+        keys = {
+            bot.DescriptionCache.make_key(b'image', 'prompt', 'model'),
+            bot.DescriptionCache.make_key(b'image', 'other prompt', 'model'),
+            bot.DescriptionCache.make_key(b'image', 'prompt', 'other model'),
+        }
+        self.assertEqual(len(keys), 3)
+
+
+class PerceptualHashTests(unittest.TestCase):
+    def test_bk_tree_matches_linear_search(self):
+        rng = random.Random(7)
+        hashes = [rng.getrandbits(64) for _ in range(300)]
+        tree = bot.BKTree()
+        for value in hashes:
+            tree.add(value)
+        for query in hashes[:20] + [rng.getrandbits(64) for _ in range(20)]:
+            expected = sorted((bot.hamming_distance(query, value), value)
+                              for value in set(hashes) if bot.hamming_distance(query, value) <= 24)
+            self.assertEqual(tree.search(query, 24), expected)
+
+    def test_flat_images_do_not_match_each_other(self):
+        red = bot.compute_dhash(encode_image(Image.new('RGB', (64, 64), 'red')))
+        blue = bot.compute_dhash(encode_image(Image.new('RGB', (64, 64), 'blue')))
+        self.assertFalse(bot.hash_has_detail(red))
+        index = bot.PerceptualIndex()
+        index.add(red, 'variant', 'A red square')
+        self.assertIsNone(index.find(blue, 'variant', 6))
+
+    def test_near_duplicate_is_found(self):
+        img = Image.new('RGB', (200, 150), 'white')
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((20, 20, 90, 120), fill='navy')
+        draw.ellipse((110, 30, 180, 100), fill='orange')
+        original = bot.compute_dhash(encode_image(img))
+        resized = bot.compute_dhash(encode_image(img.resize((100, 75)), 'JPEG'))
+        index = bot.PerceptualIndex()
+        index.add(original, 'variant', 'Shapes')
+        self.assertEqual(index.find(resized, 'variant', 6), 'Shapes')
+        self.assertIsNone(index.find(resized, 'other variant', 6))
+
+
+class TextSplittingTests(unittest.TestCase):
+    def test_split_batch_response(self):
+        text = "Image 1: A cat on a sofa.\n\n**Image 2:** A dog in the snow."
+        self.assertEqual(bot.split_batch_response(text, 2), ["A cat on a sofa.", "A dog in the snow."])
+        self.assertIsNone(bot.split_batch_response("Image 1: Only one section.", 2))
+
+    def test_find_split_point_prefers_natural_breaks(self):
+        text = "First paragraph is here.\n\nSecond paragraph goes on for a while longer."
+        self.assertEqual(text[:bot.find_split_point(text, 40)], "First paragraph is here.\n\n")
+        sentences = "One sentence here. Another sentence follows it."
+        self.assertEqual(sentences[:bot.find_split_point(sentences, 30)], "One sentence here. ")
+        self.assertEqual(bot.find_split_point("x" * 50, 20), 20)
+        self.assertEqual(bot.find_split_point("short", 20), 5)
+
+
+class RateLimitTests(unittest.IsolatedAsyncioTestCase):
+    def test_token_bucket(self):
+        bucket = bot.TokenBucket(60)
+        self.assertEqual(bucket.delay_for(60), 0.0)
+        bucket.consume(60)
+        self.assertAlmostEqual(bucket.delay_for(1), 1.0, places=1)
+        bucket.consume(-30)
+        self.assertEqual(bucket.delay_for(30), 0.0)
+
+    async def test_scheduler_round_robins_guilds_and_users(self):
+        scheduler = bot.AnalysisScheduler(workers=1, requests_per_minute=6000, tokens_per_minute=10 ** 7)
+        order = []
+
+        def job(name):
+            async def run():
+                order.append(name)
+                return name
+            return run
+
+        submitted = [
+            ('a', 1, 'a1-1'), ('a', 1, 'a1-2'), ('a', 1, 'a1-3'),
+            ('a', 2, 'a2-1'),
+            ('b', 3, 'b3-1'),
+        ]
+        futures = [scheduler.submit(guild, user, job(name))[0] for guild, user, name in submitted]
+        try:
+            await asyncio.gather(*futures)
+        finally:
+            await scheduler.stop()
+        self.assertEqual(order, ['a1-1', 'b3-1', 'a2-1', 'a1-2', 'a1-3'])
+
+    async def test_scheduler_turns_jobs_away_when_full(self):
+        scheduler = bot.AnalysisScheduler(workers=1, max_queue=1)
+        blocker = asyncio.Event()
+
+        async def wait():
+            await blocker.wait()
+
+        try:
+            scheduler.submit(None, 1, wait)
+            with self.assertRaises(bot.QueueFullError):
+                scheduler.submit(None, 2, wait)
+        finally:
+            await scheduler.stop()
+
+
+class ProgressiveDMTests(unittest.IsolatedAsyncioTestCase):
+    class Delivery:
+        def __init__(self):
+            self.sent = []
+
+        async def deliver(self, user, content=None, embed=None, message=None):
+            if message is None:
+                message = SimpleNamespace(index=len(self.sent))
+                self.sent.append(content)
+            else:
+                self.sent[message.index] = content
+            return message
+
+    async def test_failed_stream_says_so(self):
+        delivery = self.Delivery()
+        progressive = bot.ProgressiveDM(delivery, SimpleNamespace(id=1), "Image Context Analysis", interval=0)
+        await progressive.update("A cat sits on")
+        await progressive.flusher
+        self.assertTrue(delivery.sent[0].endswith("A cat sits on …"))
+        await progressive.fail()
+        self.assertEqual(delivery.sent, [
+            "**Image Context Analysis:**\n\nA cat sits on\n\n"
+            "*(The description stopped here because something went wrong. Please try again.)*"
+        ])
+
+    async def test_waits_for_the_dm_it_follows(self):
+        delivery = self.Delivery()
+        ready = asyncio.Event()
+
+        async def quick_look():
+            await ready.wait()
+            await delivery.deliver(None, "Quick Look")
+
+        after = asyncio.ensure_future(quick_look())
+        progressive = bot.ProgressiveDM(delivery, SimpleNamespace(id=1), "Image Context Analysis", interval=0, after=after)
+        await progressive.update("A cat sits on")
+        await asyncio.sleep(0.01)
+        self.assertEqual(delivery.sent, [])
+        ready.set()
+        await progressive.finish("A cat sits on a mat.")
+        self.assertEqual(delivery.sent, ["Quick Look", "**Image Context Analysis:**\n\nA cat sits on a mat."])
+
+    async def test_nothing_is_sent_for_a_stream_that_never_started(self):
+        delivery = self.Delivery()
+        progressive = bot.ProgressiveDM(delivery, SimpleNamespace(id=1), "Image Context Analysis", interval=0)
+        await progressive.fail()
+        self.assertEqual(delivery.sent, [])
+
+
+class MetricsTests(unittest.TestCase):
+    def test_sampled_totals_are_exported_as_counters(self):
+        metrics = bot.Metrics()
+        metrics.set_counter('vision_call_retries_total', 3)
+        metrics.set_counter('vision_call_retries_total', 5)
+        metrics.set_gauge('analysis_queue_waiting', 2)
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE blindbot_vision_call_retries_total counter', lines)
+        self.assertIn('blindbot_vision_call_retries_total 5', lines)
+        self.assertIn('# TYPE blindbot_analysis_queue_waiting gauge', lines)
+
+
+class RoutingConfigTests(unittest.TestCase):
+    def test_bad_guild_policy_entries_are_reported(self):
+        entries = ['123:economy', 'abc:economy', '456:cheap', '789']
+        with mock.patch.object(bot, 'ROUTING_GUILD_POLICY_ENTRIES', entries), \
+                mock.patch.object(bot, 'ROUTING_POLICY', 'quality'):
+            errors = bot.routing_config_errors()
+        self.assertEqual(len(errors), 3)
+        self.assertIn("'abc:economy'", errors[0])
+        self.assertIn("'456:cheap'", errors[1])
+        self.assertIn("'789'", errors[2])
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def test_opens_after_threshold_and_lets_one_trial_through(self):
+        breaker = bot.CircuitBreaker(failure_threshold=2, cooldown=30)
+        breaker.begin()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.begin()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(bot.CircuitOpenError):
+            breaker.check()
+
+        # Once the cooldown has passed, exactly one trial call is allowed
+        breaker.opened_at -= 31
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.begin()
+        with self.assertRaises(bot.CircuitOpenError):
+            breaker.begin()
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_failed_trial_reopens(self):
+        breaker = bot.CircuitBreaker(failure_threshold=1, cooldown=30)
+        breaker.record_failure()
+        breaker.opened_at -= 31
+        breaker.begin()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.trips, 2)
+
+
+class ResilientCallerTests(unittest.IsolatedAsyncioTestCase):
+    def caller(self, **kwargs):
+        return bot.ResilientCaller(retryable_errors=(ConnectionError,), backoff_base=0.001, **kwargs)
+
+    async def test_retries_retryable_errors(self):
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError("dropped")
+            return 'done'
+
+        caller = self.caller(max_attempts=3)
+        self.assertEqual(await caller.call(flaky), 'done')
+        self.assertEqual((len(calls), caller.retries), (3, 2))
+
+    async def test_timeouts_can_be_left_unretried(self):
+        calls = []
+
+        async def stuck():
+            calls.append(1)
+            await asyncio.sleep(1)
+
+        caller = self.caller(attempt_timeout=0.01, max_attempts=3)
+        with self.assertRaises(asyncio.TimeoutError):
+            await caller.call(stuck, hedge=False, retry_timeouts=False)
+        self.assertEqual(len(calls), 1)
+
+
+class SQLiteHistoryStoreTests(unittest.TestCase):
+    def test_unusable_database_raises_sqlite_error(self):
+        # The cog falls back to MemoryHistoryStore on sqlite3.Error, so nothing else may escape
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'history.db')
+            with open(path, 'wb') as f:
+                f.write(b'not a database' * 100)
+            with self.assertRaises(sqlite3.Error):
+                bot.SQLiteHistoryStore(path)
+            with self.assertRaises(sqlite3.Error):
+                bot.SQLiteHistoryStore(os.path.join(directory, 'missing', 'history.db'))
+
+
+class MemoryHistoryStoreTests(unittest.IsolatedAsyncioTestCase):
+    async def test_least_recently_active_user_loses_oldest_entries(self):
+        store = bot.MemoryHistoryStore(max_per_user=10, max_entries=3)
+        await store.add(1, history_entry('first'))
+        await store.add(1, history_entry('second'))
+        await store.add(2, history_entry('other user'))
+        # User 1 is now the least recently active, so their oldest entry goes
+        await store.add(2, history_entry('other user again'))
+        self.assertEqual([entry['context'] for entry in await store.recent(1)], ['second'])
+        self.assertEqual(await store.count(2), 2)
+        self.assertEqual(store.stats()['entries'], 3)
+        self.assertEqual(store.evicted, 1)
+
+    async def test_byte_budget_and_compression(self):
+        store = bot.MemoryHistoryStore(max_entries=100, max_bytes=4000, compress=True)
+        for i in range(20):
+            await store.add(i, history_entry(f"Description number {i}. " * 20))
+        self.assertLessEqual(store.stats()['bytes'], 4000)
+        latest = await store.recent(19)
+        self.assertEqual(latest[0]['context'], "Description number 19. " * 20)
+
+    async def test_flat_hashes_are_never_similar(self):
+        store = bot.MemoryHistoryStore()
+        await store.add(1, history_entry('A red square', phash=0))
+        self.assertFalse(await store.has_similar(1, 0, 6))
+
+
+class AttachmentRenditionTests(unittest.TestCase):
+    def attachment(self, width, height, filename='photo.jpg', content_type='image/jpeg',
+                   proxy_url='https://media.example/photo.jpg'):
+        return SimpleNamespace(width=width, height=height, filename=filename,
+                               content_type=content_type, proxy_url=proxy_url)
+
+    def test_large_image_gets_a_scaled_rendition(self):
+        url = bot.proxy_rendition_url(self.attachment(4000, 3000), 1536)
+        self.assertEqual(url, 'https://media.example/photo.jpg?width=1536&height=1152')
+        signed = self.attachment(4000, 3000, proxy_url='https://media.example/photo.jpg?ex=1')
+        self.assertTrue(bot.proxy_rendition_url(signed, 1536).startswith('https://media.example/photo.jpg?ex=1&width='))
+
+    def test_indexed_attachments_get_renditions_too(self):
+        ref = bot.AttachmentRef(1, 'photo.jpg', 'https://cdn.example/photo.jpg', 2_000_000,
+                                'https://media.example/photo.jpg', 3000, 4000, 'image/jpeg')
+        self.assertEqual(bot.proxy_rendition_url(ref, 1536), 'https://media.example/photo.jpg?width=1152&height=1536')
+
+    def test_originals_are_used_when_a_rendition_would_not_help(self):
+        self.assertIsNone(bot.proxy_rendition_url(self.attachment(1000, 800), 1536))
+        self.assertIsNone(bot.proxy_rendition_url(self.attachment(4000, 3000), 0))
+        self.assertIsNone(bot.proxy_rendition_url(self.attachment(None, None), 1536))
+        self.assertIsNone(bot.proxy_rendition_url(self.attachment(4000, 3000, 'clip.gif', 'image/gif'), 1536))
+
+
+class PreviewTests(unittest.TestCase):
+    def test_solid_colour_is_trivial(self):
+        preview = bot.build_preview(encode_image(Image.new('RGB', (800, 600), (30, 90, 220))))
+        self.assertTrue(preview.trivial)
+        self.assertEqual(preview.kind, 'a solid colour')
+        self.assertEqual(preview.orientation, 'landscape')
+        self.assertEqual(preview.colours[0][1], 'blue')
+        self.assertIn('solid blue', bot.trivial_description(preview))
+
+    def test_tiny_image_is_trivial(self):
+        img = Image.new('RGB', (32, 32), 'white')
+        ImageDraw.Draw(img).ellipse((4, 4, 28, 28), fill='yellow')
+        preview = bot.build_preview(encode_image(img))
+        self.assertTrue(preview.trivial)
+        self.assertEqual(preview.orientation, 'square')
+
+    def test_text_on_a_plain_background_is_not_trivial(self):
+        img = Image.new('RGB', (900, 400), 'white')
+        draw = ImageDraw.Draw(img)
+        for row in range(8):
+            draw.text((20, 20 + row * 40), "The quick brown fox jumps over the lazy dog " * 2, fill='black')
+        preview = bot.build_preview(encode_image(img))
+        self.assertFalse(preview.trivial)
+        self.assertEqual(preview.kind, 'a screenshot or text')
+
+    def test_small_text_on_a_large_plain_background_is_not_trivial(self):
+        img = Image.new('RGB', (2400, 1600), 'white')
+        ImageDraw.Draw(img).text((1000, 700), "hi", fill='black', font=ImageFont.load_default(size=40))
+        for image_format in ('PNG', 'JPEG'):
+            preview = bot.build_preview(encode_image(img, image_format))
+            self.assertFalse(preview.trivial, image_format)
+            self.assertNotEqual(preview.kind, 'a solid colour')
+
+    def test_small_object_on_a_large_plain_background_is_not_trivial(self):
+        img = Image.new('RGB', (3000, 2000), (240, 240, 240))
+        ImageDraw.Draw(img).ellipse((1500, 1000, 1540, 1040), fill='red')
+        for image_format in ('PNG', 'JPEG'):
+            self.assertFalse(bot.build_preview(encode_image(img, image_format)).trivial, image_format)
+
+    def test_light_gray_is_not_called_white(self):
+        preview = bot.build_preview(encode_image(Image.new('RGB', (640, 480), (240, 240, 240)), 'JPEG'))
+        self.assertTrue(preview.trivial)
+        self.assertIn('solid light gray', bot.trivial_description(preview))
+
+    def test_only_small_files_wait_for_their_preview(self):
+        solid = encode_image(Image.new('RGB', (1600, 1200), (200, 120, 40)), 'JPEG')
+        self.assertTrue(bot.might_be_trivial(solid))
+        rng = random.Random(3)
+        noise = Image.new('RGB', (64, 48))
+        noise.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(64 * 48)])
+        photo = encode_image(noise.resize((1600, 1200), Image.BICUBIC), 'JPEG')
+        self.assertFalse(bot.might_be_trivial(photo))
+        self.assertTrue(bot.might_be_trivial(encode_image(noise.resize((40, 30)))))
+
+    def test_transparent_pixels_are_not_counted(self):
+        img = Image.new('RGBA', (300, 300), (0, 0, 0, 0))
+        ImageDraw.Draw(img).rectangle((100, 100, 200, 200), fill=(220, 30, 30, 255))
+        preview = bot.build_preview(encode_image(img))
+        self.assertEqual(preview.colours[0][1], 'red')
+
+
+if __name__ == '__main__':
+    unittest.main()